@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# Fake MPRIS player for the benchmark, to be run on a private session bus:
+#
+#   mpris-player.py NAME
+#
+# Owns org.mpris.MediaPlayer2.NAME, then reads commands on stdin, one per
+# line: "play TITLE", "pause", "stop", "seek" or "quit". After emitting the
+# matching signal, it prints the time.monotonic() timestamp of the emission
+# on stdout.
+
+import sys
+import time
+import asyncio
+from dbus_next import Variant, PropertyAccess
+from dbus_next.aio import MessageBus
+from dbus_next.service import ServiceInterface, dbus_property, signal
+
+INTERFACE = 'org.mpris.MediaPlayer2.Player'
+
+
+class Player(ServiceInterface):
+    def __init__(self):
+        super().__init__(INTERFACE)
+        self.status = 'Stopped'
+        self.title = ''
+
+    @dbus_property(access=PropertyAccess.READ)
+    def PlaybackStatus(self) -> 's':
+        return self.status
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Metadata(self) -> 'a{sv}':
+        return {
+                'xesam:title': Variant('s', self.title),
+                'xesam:artist': Variant('as', ['bench']),
+                'xesam:url': Variant('s', f'file:///bench/{self.title}'),
+                }
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Volume(self) -> 'd':
+        return 1.0
+
+    @signal()
+    def Seeked(self) -> 'x':
+        return 0
+
+    def command(self, line):
+        action, _, argument = line.strip().partition(' ')
+        changed = {}
+        if action == 'play':
+            self.status = 'Playing'
+            self.title = argument
+            changed['Metadata'] = self.Metadata
+        elif action == 'pause':
+            self.status = 'Paused'
+        elif action == 'stop':
+            self.status = 'Stopped'
+        elif action == 'seek':
+            self.Seeked()
+        elif action == 'quit':
+            return False
+        if action in ('play', 'pause', 'stop'):
+            changed['PlaybackStatus'] = self.status
+            self.emit_properties_changed(changed)
+        print(time.monotonic(), flush=True)
+        return True
+
+
+async def main(name):
+    loop = asyncio.get_running_loop()
+    player = Player()
+    bus = await MessageBus().connect()
+    bus.export('/org/mpris/MediaPlayer2', player)
+    await bus.request_name(f'org.mpris.MediaPlayer2.{name}')
+    print('ready', flush=True)
+    while True:
+        line = await loop.run_in_executor(None, sys.stdin.readline)
+        if not line or not player.command(line):
+            break
+    bus.disconnect()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(sys.argv[1]))
+
+
+# vim: set ft=python fdm=indent ai ts=4 sw=4 tw=79 et:
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+# Fake notification server for the benchmark, to be run on a private session
+# bus:
+#
+#   notification-server.py
+#
+# Owns org.freedesktop.Notifications and, for every Notify call, prints the
+# id of the notification, the id it replaces and its summary on stdout, tab
+# separated. A new id is only allocated when no id to replace is given.
+
+import sys
+import asyncio
+from dbus_next.aio import MessageBus
+from dbus_next.service import ServiceInterface, method
+
+INTERFACE = 'org.freedesktop.Notifications'
+
+
+class Notifications(ServiceInterface):
+    def __init__(self):
+        super().__init__(INTERFACE)
+        self.last_id = 0
+
+    @method()
+    def Notify(self, app_name: 's', replaces_id: 'u', app_icon: 's', summary: 's',
+            body: 's', actions: 'as', hints: 'a{sv}', expire_timeout: 'i') -> 'u':
+        if replaces_id:
+            id = replaces_id
+        else:
+            self.last_id += 1
+            id = self.last_id
+        print(id, replaces_id, summary, sep='\t', flush=True)
+        return id
+
+    @method()
+    def CloseNotification(self, id: 'u'):
+        pass
+
+    @method()
+    def GetCapabilities(self) -> 'as':
+        return ['body']
+
+    @method()
+    def GetServerInformation(self) -> 'ssss':
+        return ['bench', 'ui-statuses', '0', '1.2']
+
+
+async def main():
+    bus = await MessageBus().connect()
+    bus.export('/org/freedesktop/Notifications', Notifications())
+    await bus.request_name(INTERFACE)
+    print('ready', flush=True)
+    await bus.wait_for_disconnect()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
+
+
+# vim: set ft=python fdm=indent ai ts=4 sw=4 tw=79 et:
@@ -0,0 +1,128 @@
+# Stand-in for pulsectl_asyncio, driven by the benchmark: no PulseAudio
+# server is needed. Sinks and sources are kept in memory, set_volume()
+# changes one and emits the matching event to every subscriber, and CALLS
+# counts the requests made by clients, as many server round-trips.
+
+import asyncio
+from collections import Counter
+
+CALLS = Counter()
+
+
+class PulseIndexError(Exception):
+    pass
+
+
+class Volume:
+    def __init__(self, value_flat):
+        self.value_flat = value_flat
+
+
+class Device:
+    def __init__(self, index, name, value=0.5, mute=0):
+        self.index = index
+        self.name = name
+        self.volume = Volume(value)
+        self.mute = mute
+
+
+class ServerInfo:
+    def __init__(self, default_sink_name, default_source_name):
+        self.default_sink_name = default_sink_name
+        self.default_source_name = default_source_name
+
+
+class Event:
+    def __init__(self, facility, index, t='change'):
+        self.facility = facility
+        self.index = index
+        self.t = t
+
+    def __repr__(self):
+        return f'<Event {self.facility} #{self.index} {self.t}>'
+
+
+SINKS = {0: Device(0, 'bench-sink')}
+SOURCES = {0: Device(0, 'bench-source')}
+SERVER = ServerInfo('bench-sink', 'bench-source')
+SUBSCRIBERS = []
+
+
+def emit(facility, index, t='change'):
+    for facilities, queue in SUBSCRIBERS:
+        if facility in facilities:
+            queue.put_nowait(Event(facility, index, t))
+
+
+def set_volume(value, mute=False, index=0, facility='sink'):
+    devices = SINKS if facility == 'sink' else SOURCES
+    devices[index].volume = Volume(value)
+    devices[index].mute = 1 if mute else 0
+    emit(facility, index)
+
+
+def set_default_sink(name):
+    SERVER.default_sink_name = name
+    emit('server', None)
+
+
+class PulseAsync:
+    def __init__(self, client_name=None):
+        self.client_name = client_name
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def server_info(self):
+        CALLS['server_info'] += 1
+        return SERVER
+
+    @staticmethod
+    def by_name(devices, name):
+        for device in devices.values():
+            if device.name == name:
+                return device
+        raise KeyError(name)
+
+    async def get_sink_by_name(self, name):
+        CALLS['get_sink_by_name'] += 1
+        return self.by_name(SINKS, name)
+
+    async def get_source_by_name(self, name):
+        CALLS['get_source_by_name'] += 1
+        return self.by_name(SOURCES, name)
+
+    async def sink_list(self):
+        CALLS['sink_list'] += 1
+        return [SINKS[index] for index in sorted(SINKS)]
+
+    async def source_list(self):
+        CALLS['source_list'] += 1
+        return [SOURCES[index] for index in sorted(SOURCES)]
+
+    @staticmethod
+    def by_index(devices, index):
+        if index not in devices:
+            raise PulseIndexError(index)
+        return devices[index]
+
+    async def sink_info(self, index):
+        CALLS['sink_info'] += 1
+        return self.by_index(SINKS, index)
+
+    async def source_info(self, index):
+        CALLS['source_info'] += 1
+        return self.by_index(SOURCES, index)
+
+    async def subscribe_events(self, *facilities):
+        queue = asyncio.Queue()
+        subscriber = (facilities, queue)
+        SUBSCRIBERS.append(subscriber)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            SUBSCRIBERS.remove(subscriber)
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+# Record /proc snapshots for the benchmark, one frame per interval:
+#
+#   bench/record.py [-n FRAMES] [-i SECONDS] [-o bench/fixtures/proc]
+
+import os
+import sys
+import time
+import shutil
+import argparse
+
+FILES = [
+        'stat',
+        'meminfo',
+        'loadavg',
+        'net/dev',
+        'diskstats',
+        ]
+
+
+def record(dest, frames, interval, proc='/proc'):
+    for frame in range(frames):
+        for name in FILES:
+            path = os.path.join(dest, str(frame), name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(os.path.join(proc, name), 'rb') as f:
+                data = f.read()
+            with open(path, 'wb') as f:
+                f.write(data)
+        if frame + 1 < frames:
+            time.sleep(interval)
+
+
+if __name__ == '__main__':
+    fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'proc')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--frames', type=int, default=5)
+    parser.add_argument('-i', '--interval', type=float, default=1)
+    parser.add_argument('-o', '--output', default=fixtures)
+    args = parser.parse_args()
+
+    if os.path.isdir(args.output):
+        shutil.rmtree(args.output)
+    record(args.output, args.frames, args.interval)
+
+
+# vim: set ft=python fdm=indent ai ts=4 sw=4 tw=79 et:
@@ -0,0 +1,546 @@
+#!/usr/bin/env python3
+
+# Benchmark ui-statuses offline, against stand-ins for its sources:
+#
+#   - a fake procfs, fed from the frames recorded in bench/fixtures/proc
+#     (see bench/record.py), read through ui-statuses --proc
+#   - a fake pulsectl_asyncio module (bench/fakes/pulsectl_asyncio.py)
+#   - fake MPRIS players (bench/fakes/mpris-player.py) and a fake
+#     notification server (bench/fakes/notification-server.py) on a private
+#     dbus-daemon session bus
+#
+# and report:
+#
+#   ticks     CPU time per tick and per sample of each sampler, read/write
+#             system calls per tick (from /proc/thread-self/io, or every
+#             system call with --strace), writes per tag
+#   latency   from source event to status file write, then to the line
+#             printed by the reader (polybar-sysmon for procfs,
+#             polybar-status for volume and mpris), volume notifications
+#             sent for a held volume key
+#   startup   wall time of each script up to its argument parsing (--help),
+#             and its module imports as measured by python -X importtime
+#
+# Usage:
+#
+#   bench/run.py [--ticks N] [--samples N] [--json FILE]
+#                [--compare BASELINE] [--tolerance RATIO] [--strace]
+#
+# With --compare, exit with status 1 when a metric is worse than the one of
+# the baseline (a previous --json output) by more than the tolerance.
+
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import statistics
+import subprocess
+import importlib.util
+import importlib.machinery
+from collections import Counter
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+TOP = os.path.dirname(BENCH)
+FIXTURES = os.path.join(BENCH, 'fixtures', 'proc')
+DAEMON = os.path.join(TOP, 'bin', 'ui-statuses.py')
+SYSMON = os.path.join(TOP, 'polybar', 'polybar-sysmon.py')
+STATUS = os.path.join(TOP, 'polybar', 'polybar-status.py')
+PLAYER = os.path.join(BENCH, 'fakes', 'mpris-player.py')
+NOTIFICATIONS = os.path.join(BENCH, 'fakes', 'notification-server.py')
+
+# Stand-ins first, then the modules shared by the scripts
+PYTHONPATH = [os.path.join(BENCH, 'fakes'), os.path.join(TOP, 'lib')]
+
+
+def load_daemon():
+    sys.path[:0] = PYTHONPATH
+    loader = importlib.machinery.SourceFileLoader('ui_statuses', DAEMON)
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    # Set from the command line when run as a script
+    module.BLACKLIST = []
+    module.TRUNCATE_STRING = '…'
+    module.ICON_PLAYING = 'P'
+    module.ICON_PAUSED = 'p'
+    module.ICON_STOPPED = 's'
+    module.ICON_NONE = 'n'
+    return module
+
+
+def start_bus():
+    # Private session bus, so that nothing depends on the desktop session
+    proc = subprocess.Popen(
+            ['dbus-daemon', '--session', '--nofork', '--nopidfile', '--print-address=1'],
+            stdout=subprocess.PIPE,
+            text=True,
+            )
+    os.environ['DBUS_SESSION_BUS_ADDRESS'] = proc.stdout.readline().strip()
+    return proc
+
+
+class FakeProc:
+    def __init__(self, fixtures=FIXTURES):
+        self.frames = []
+        for frame in sorted(os.listdir(fixtures), key=int):
+            top = os.path.join(fixtures, frame)
+            files = {}
+            for dirpath, _, filenames in os.walk(top):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    with open(path, 'rb') as f:
+                        files[os.path.relpath(path, top)] = f.read()
+            self.frames.append(files)
+        self.root = tempfile.mkdtemp(prefix='ui-statuses-proc-')
+        self.frame(0)
+
+    def write(self, name, data):
+        # In place, as the daemon keeps its /proc files open
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+            f.write(data)
+            f.truncate()
+
+    def frame(self, index):
+        for name, data in self.frames[index % len(self.frames)].items():
+            self.write(name, data)
+
+    def close(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+#- FakeProc
+
+
+class CountingBackend:
+    def __init__(self, backend):
+        self.backend = backend
+        self.writes = Counter()
+        self.times = {}
+        self.waiters = {}
+
+    def write(self, tag, line):
+        self.backend.write(tag, line)
+        self.writes[tag] += 1
+        self.times[tag] = time.monotonic()
+        waiter = self.waiters.pop(tag, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(self.times[tag])
+
+    async def wait(self, tag, timeout=5):
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters[tag] = waiter
+        return await asyncio.wait_for(waiter, timeout)
+#- CountingBackend
+
+
+def rw_syscalls():
+    counters = {}
+    with open('/proc/thread-self/io') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            counters[key] = int(value)
+    return counters['syscr'] + counters['syscw']
+
+
+async def bench_ticks(uis, proc, ticks, root):
+    if not ticks:
+        return {}
+    queue = uis.StatusStore()
+    samplers = [
+            uis.CpuPercent(queue, detail=True),
+            uis.LoadAvg(queue),
+            uis.MemPercent(queue),
+            uis.NetSpeed(queue),
+            uis.DiskIO(queue),
+            ]
+    backend = CountingBackend(uis.FileBackend(root))
+    consumer = asyncio.create_task(uis.consumer([backend], queue))
+    cpu = Counter()
+    samples = Counter()
+    # Reading /proc/thread-self/io costs system calls too
+    first = rw_syscalls()
+    overhead = rw_syscalls() - first
+    syscalls = 0
+    for tick in range(ticks):
+        proc.frame(tick)
+        before = rw_syscalls()
+        # One tick per second, each sampler at its own interval
+        for sampler in samplers:
+            if tick % sampler.interval:
+                continue
+            start = time.thread_time_ns()
+            sampler.sample()
+            cpu[sampler.name] += time.thread_time_ns() - start
+            samples[sampler.name] += 1
+        start = time.thread_time_ns()
+        await queue.join()
+        cpu['consumer'] += time.thread_time_ns() - start
+        syscalls += rw_syscalls() - before - overhead
+    consumer.cancel()
+    writes = sum(backend.writes.values())
+    return {
+            'cpu_us_per_tick': sum(cpu.values()) / ticks / 1000,
+            'cpu_us_per_sample': {
+                name: cpu[name] / (samples[name] or ticks) / 1000
+                for name in cpu
+                },
+            'rw_syscalls_per_tick': syscalls / ticks,
+            'rw_syscalls_per_write': syscalls / writes if writes else 0,
+            'writes_per_tick': writes / ticks,
+            'writes': dict(backend.writes),
+            }
+
+
+def strace_ticks(ticks):
+    # Count every system call of a child running the ticks, minus the ones
+    # of a child running none (startup and module loading)
+    def count(n):
+        with tempfile.NamedTemporaryFile('r') as out:
+            subprocess.run(
+                    ['strace', '-f', '-c', '-q', '-o', out.name,
+                        sys.executable, __file__, '--stage', 'ticks',
+                        '--ticks', str(n)],
+                    check=True,
+                    stdout=subprocess.DEVNULL,
+                    )
+            lines = [line.split() for line in out if line.strip()]
+        return int(lines[-1][3]) if lines[-1][-1] == 'total' else 0
+    return (count(ticks) - count(0)) / ticks
+
+
+def reader_env(runtime):
+    env = dict(os.environ)
+    env['XDG_RUNTIME_DIR'] = runtime
+    env['PYTHONPATH'] = os.pathsep.join(PYTHONPATH)
+    return env
+
+
+async def start_reader(runtime, *cmdargs):
+    if importlib.util.find_spec('inotify') is None:
+        return None
+    reader = await asyncio.create_subprocess_exec(
+            sys.executable, *cmdargs,
+            stdout=asyncio.subprocess.PIPE,
+            env=reader_env(runtime),
+            )
+    # Let it set up its watch
+    await asyncio.sleep(1)
+    return reader
+
+
+async def read_line(reader, timeout=5):
+    if reader is None:
+        return None
+    try:
+        line = await asyncio.wait_for(reader.stdout.readline(), timeout)
+    except asyncio.TimeoutError:
+        return None
+    return time.monotonic() if line else None
+
+
+def stop_reader(reader):
+    if reader is not None and reader.returncode is None:
+        reader.terminate()
+
+
+def summary(latencies):
+    values = [latency * 1000 for latency in latencies if latency is not None]
+    if not values:
+        return None
+    values.sort()
+    return {
+            'median_ms': statistics.median(values),
+            'p95_ms': values[min(len(values) - 1, int(len(values) * 0.95))],
+            'samples': len(values),
+            }
+
+
+async def latency_procfs(uis, proc, runtime, samples):
+    root = os.path.join(runtime, 'ui-statuses')
+    queue = uis.StatusStore()
+    backend = CountingBackend(uis.FileBackend(root))
+    consumer = asyncio.create_task(uis.consumer([backend], queue))
+    user, idle = 0, 0
+
+    def write_stat(busy):
+        nonlocal user, idle
+        user += busy
+        idle += 100 - busy
+        line = f'{user} 0 0 {idle} 0 0 0 0 0 0'
+        proc.write('stat', f'cpu  {line}\ncpu0 {line}\nintr 0\n'.encode())
+
+    write_stat(50)
+    sampler = uis.CpuPercent(queue)
+    sampler.sample()
+    await queue.join()
+    reader = await start_reader(runtime, SYSMON)
+    writes, reads = [], []
+    for sample in range(samples):
+        # A different value each time
+        write_stat(10 + sample * 7 % 80)
+        start = time.monotonic()
+        sampler.sample()
+        written = await backend.wait('cpupercent')
+        read = await read_line(reader)
+        writes.append(written - start)
+        reads.append(read - written if read else None)
+    stop_reader(reader)
+    consumer.cancel()
+    return {'write': summary(writes), 'reader': summary(reads)}
+
+
+async def latency_volume(uis, runtime, samples, frame=0.05):
+    import pulsectl_asyncio
+    root = os.path.join(runtime, 'ui-statuses')
+    queue = uis.StatusStore()
+    backend = CountingBackend(uis.FileBackend(root))
+    consumer = asyncio.create_task(uis.consumer([backend], queue))
+    collector = asyncio.create_task(uis.volume(queue, frame=frame))
+    await asyncio.sleep(0.1)
+    reader = await start_reader(runtime, STATUS, '#ffffff', 'volume')
+    calls = sum(pulsectl_asyncio.CALLS.values())
+    writes, reads = [], []
+    for sample in range(samples):
+        # Changes closer than a frame are coalesced, keep them apart
+        await asyncio.sleep(frame)
+        start = time.monotonic()
+        pulsectl_asyncio.set_volume((10 + sample * 7 % 80) / 100)
+        try:
+            written = await backend.wait('volume')
+        except asyncio.TimeoutError:
+            continue
+        read = await read_line(reader)
+        writes.append(written - start)
+        reads.append(read - written if read else None)
+    calls = (sum(pulsectl_asyncio.CALLS.values()) - calls) / samples
+    # A held volume key: many changes in a row, within a few frames
+    await asyncio.sleep(frame)
+    written = backend.writes['volume']
+    for sample in range(samples):
+        pulsectl_asyncio.set_volume((10 + sample % 80) / 100)
+        await asyncio.sleep(0)
+    await asyncio.sleep(frame * 2)
+    stop_reader(reader)
+    collector.cancel()
+    consumer.cancel()
+    return {
+            'write': summary(writes),
+            'reader': summary(reads),
+            'pulse_calls_per_event': calls,
+            'burst_writes': backend.writes['volume'] - written,
+            }
+
+
+async def latency_notify(uis, runtime, samples, frame=0.05):
+    import pulsectl_asyncio
+    server = await asyncio.create_subprocess_exec(
+            sys.executable, NOTIFICATIONS,
+            stdout=asyncio.subprocess.PIPE,
+            )
+    if not await server.stdout.readline():
+        await server.wait()
+        return {'skipped': 'fake notification server failed to start'}
+    queue = uis.StatusStore()
+    consumer = asyncio.create_task(uis.consumer([], queue))
+    notifier = uis.VolumeNotification()
+    collector = asyncio.create_task(uis.volume(queue, frame=frame, notifier=notifier))
+    await asyncio.sleep(0.1)
+    # A held volume key: one notification per frame at most, all of them
+    # replacing the first one
+    start = time.monotonic()
+    for sample in range(samples):
+        pulsectl_asyncio.set_volume((10 + sample % 80) / 100)
+        await asyncio.sleep(frame / 5)
+    elapsed = time.monotonic() - start
+    await asyncio.sleep(frame * 2)
+    ids = []
+    while True:
+        try:
+            line = await asyncio.wait_for(server.stdout.readline(), 0.5)
+        except asyncio.TimeoutError:
+            break
+        if not line:
+            break
+        ids.append(line.split(b'\t')[0])
+    collector.cancel()
+    consumer.cancel()
+    server.terminate()
+    await server.wait()
+    return {
+            'changes': samples,
+            'notifications': len(ids),
+            'frames': elapsed / frame,
+            'notification_ids': len(set(ids)),
+            }
+
+
+async def latency_mpris(uis, runtime, samples):
+    root = os.path.join(runtime, 'ui-statuses')
+    player = await asyncio.create_subprocess_exec(
+            sys.executable, PLAYER, 'bench',
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            )
+    if not await player.stdout.readline():
+        await player.wait()
+        return {'skipped': 'fake player failed to start'}
+    queue = uis.StatusStore()
+    backend = CountingBackend(uis.FileBackend(root))
+    consumer = asyncio.create_task(uis.consumer([backend], queue))
+    collector = asyncio.create_task(uis.mpris(queue))
+    await asyncio.sleep(1)
+    reader = await start_reader(runtime, STATUS, '#ffffff', 'mpris')
+    writes, reads = [], []
+    for sample in range(samples):
+        waiter = asyncio.create_task(backend.wait('mpris'))
+        player.stdin.write(f'play title-{sample}\n'.encode())
+        start = float(await player.stdout.readline())
+        try:
+            written = await waiter
+        except asyncio.TimeoutError:
+            continue
+        read = await read_line(reader)
+        writes.append(written - start)
+        reads.append(read - written if read else None)
+    stop_reader(reader)
+    player.stdin.write(b'quit\n')
+    await player.wait()
+    collector.cancel()
+    consumer.cancel()
+    return {'write': summary(writes), 'reader': summary(reads)}
+
+
+def import_times(stderr):
+    # "import time: self [us] | cumulative | imported package", nested
+    # imports are indented
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  ') and cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative) / 1000
+    return times
+
+
+def bench_startup(runtime, runs):
+    results = {}
+    env = reader_env(runtime)
+    for name, script in [
+            ('ui-statuses', DAEMON),
+            ('polybar-status', STATUS),
+            ('polybar-sysmon', SYSMON),
+            ]:
+        walls = []
+        for run in range(runs):
+            start = time.monotonic()
+            process = subprocess.run(
+                    [sys.executable, '-X', 'importtime', script, '--help'],
+                    env=env,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.PIPE,
+                    text=True,
+                    )
+            walls.append(time.monotonic() - start)
+        if process.returncode != 0:
+            results[name] = {'skipped': process.stderr.strip().splitlines()[-1]}
+            continue
+        imports = import_times(process.stderr)
+        slowest = sorted(imports, key=imports.get, reverse=True)[:5]
+        results[name] = {
+                'wall': summary(walls),
+                'imports_ms': sum(imports.values()),
+                'slowest_imports_ms': {module: imports[module] for module in slowest},
+                }
+    return results
+
+
+async def run(uis, args):
+    results = {}
+    # Statuses are written to a tmpfs, like the runtime directory
+    runtime = tempfile.mkdtemp(
+            prefix='ui-statuses-run-',
+            dir=os.environ.get('XDG_RUNTIME_DIR', '/dev/shm'),
+            )
+    proc = FakeProc()
+    uis.PROC_ROOT = proc.root
+    # No block devices nor sensors to find: nothing depends on the host
+    uis.SYS_ROOT = os.path.join(runtime, 'sys')
+    os.mkdir(uis.SYS_ROOT)
+    try:
+        if args.stage in ('ticks', 'all'):
+            root = os.path.join(runtime, 'ticks')
+            results['ticks'] = await bench_ticks(uis, proc, args.ticks, root)
+            if args.strace and args.ticks:
+                results['ticks']['syscalls_per_tick'] = strace_ticks(args.ticks)
+        if args.stage in ('latency', 'all'):
+            results['latency'] = {
+                    'procfs': await latency_procfs(uis, proc, runtime, args.samples),
+                    'volume': await latency_volume(uis, runtime, args.samples),
+                    'mpris': await latency_mpris(uis, runtime, args.samples),
+                    'notify': await latency_notify(uis, runtime, args.samples),
+                    }
+        if args.stage in ('startup', 'all'):
+            results['startup'] = bench_startup(runtime, args.samples)
+    finally:
+        proc.close()
+        shutil.rmtree(runtime, ignore_errors=True)
+    return results
+
+
+def flatten(results, prefix=''):
+    metrics = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            metrics.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)) and not key == 'samples':
+            metrics[f'{prefix}{key}'] = value
+    return metrics
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    current = flatten(results)
+    for name, reference in flatten(baseline).items():
+        value = current.get(name)
+        if value is not None and value > reference * (1 + tolerance) and value - reference > 1e-3:
+            regressions.append(f'{name}: {value:.3f} (baseline {reference:.3f})')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stage', choices=['ticks', 'latency', 'startup', 'all'], default='all')
+    parser.add_argument('--ticks', type=int, default=300, help='simulated seconds of sampling')
+    parser.add_argument('--samples', type=int, default=20, help='events per latency measure')
+    parser.add_argument('--strace', action='store_true', help='also count every system call with strace')
+    parser.add_argument('--json', metavar='FILE', help='write the results to FILE')
+    parser.add_argument('--compare', metavar='BASELINE', help='fail on regressions against BASELINE')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    bus = start_bus()
+    try:
+        uis = load_daemon()
+        results = asyncio.run(run(uis, args))
+    finally:
+        bus.terminate()
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.json:
+        with open(args.json, 'w') as f:
+            f.write(output + '\n')
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'regression: {regression}', file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+# vim: set ft=python fdm=indent ai ts=4 sw=4 tw=79 et:
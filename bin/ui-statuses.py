@@ -2,20 +2,26 @@
 
 import os
 import sys
-import locale
 import asyncio
-#  import signal
+import json
+import signal
 import argparse
-#  from contextlib import suppress
+import select
+from contextlib import suppress
 
-import pulsectl_asyncio
+# Dependencies of a single collector (pulsectl_asyncio, dbus_next) are only
+# imported when it is enabled
 #  from mprisctl import PlayerManager
 #  import aiofiles
 
 import time
-from operator import itemgetter
-from pydbus import SessionBus
-from gi.repository import GLib
+import math
+from fnmatch import fnmatch
+from array import array
+from bisect import bisect_left, insort
+from heapq import nlargest
+from collections import Counter, deque
+from operator import add, sub
 
 def get_volume_icon(value: float, mute: bool):
     muted = ''
@@ -36,33 +42,220 @@ def get_volume_icon(value: float, mute: bool):
 def shorten(s: str, t: str, l: int):
     return s if (len(s) <= l) else s[:l] + t
 
-async def volume(queue: asyncio.Queue):
-    def raw(value, mute):
-        return ('rawvolume', '', str(value) + ('!' if mute else ''))
-
-    def status(value, mute):
-        return ('volume', get_volume_icon(value, mute), f'{value: 3d}%')
-
-    async with pulsectl_asyncio.PulseAsync('event-printer') as pulse:
-        # Get name of monitor_source of default sink
-        server_info = await pulse.server_info()
-        sink_info = await pulse.get_sink_by_name(server_info.default_sink_name)
-        #  print(sink_info)
-        index = sink_info.index
-        async for event in pulse.subscribe_events('sink'):
-            #  print('Pulse event:', event)
-            if index == event.index:
-                sinks = await pulse.sink_list()
-                value = round(sinks[index].volume.value_flat * 100)
-                mute = sinks[index].mute == 1
-                queue.put_nowait(raw(value, mute))
-                queue.put_nowait(status(value, mute))
+class StatusStore:
+    # Latest status of each tag not written yet, instead of a queue of every
+    # status put: a status put again before being written replaces the
+    # previous one, so that memory stays bounded when the consumer stalls,
+    # and the freshest status only is written. Producers keep the queue API:
+    # put_nowait of a (tag, icon, output) tuple, from the event loop.
+    def __init__(self, stats=None):
+        self.dirty = {}
+        self.stats = stats
+        self.ready = asyncio.Event()
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    def put_nowait(self, item):
+        tag, icon, output = item
+        if self.stats is not None and tag in self.dirty:
+            self.stats.conflated[tag] += 1
+        self.dirty[tag] = (icon, output)
+        self.idle.clear()
+        self.ready.set()
+
+    def qsize(self):
+        return len(self.dirty)
+
+    def empty(self):
+        return not self.dirty
+
+    async def get(self) -> dict:
+        # All the dirty tags at once, tag -> (icon, output)
+        while not self.dirty:
+            self.ready.clear()
+            await self.ready.wait()
+        batch, self.dirty = self.dirty, {}
+        return batch
+
+    def task_done(self):
+        # The last batch was written
+        if not self.dirty:
+            self.idle.set()
+
+    async def join(self):
+        await self.idle.wait()
+#- StatusStore
+
+def get_mic_icon(value: float, mute: bool):
+    muted = ''
+    return muted if mute else ''
+
+class VolumeNotification:
+    # Desktop notification, replaced in place by the next one through its id
+    # instead of stacking up, like notify-send --hint=string:synchronous:volume
+    def __init__(self, app_name='volume-notifier', timeout=1000):
+        self.app_name = app_name
+        self.timeout = timeout
+        self.bus = None
+        self.id = 0
+
+    async def connect(self):
+        from dbus_next.aio import MessageBus
+        self.bus = await MessageBus().connect()
+
+    async def notify(self, value: int, mute: bool, previous: int):
+        from dbus_next import Message, MessageType, Variant
+        if self.bus is None:
+            await self.connect()
+        hints = {
+                'urgency': Variant('y', 0),
+                'transient': Variant('b', True),
+                'synchronous': Variant('s', 'volume'),
+                'x-canonical-private-synchronous': Variant('s', 'volume'),
+                }
+        if mute:
+            icon, summary, body = 'audio-volume-muted', 'Mute toggle', f'Muted: Volume {value}%'
+        else:
+            up = value >= previous
+            icon = 'audio-volume-high' if up else 'audio-volume-low'
+            summary, body = f"Volume {'up' if up else 'down'} {value}%", ''
+            hints['value'] = Variant('i', value)
+        reply = await self.bus.call(Message(
+                destination='org.freedesktop.Notifications',
+                path='/org/freedesktop/Notifications',
+                interface='org.freedesktop.Notifications',
+                member='Notify',
+                signature='susssasa{sv}i',
+                body=[self.app_name, self.id, icon, summary, body, [], hints, self.timeout],
+                ))
+        if reply.message_type == MessageType.METHOD_RETURN:
+            self.id = reply.body[0]
+
+    def close(self):
+        if self.bus is not None:
+            self.bus.disconnect()
+#- VolumeNotification
+
+class VolumeXob:
+    # xob reads "value" or "value!" (muted) lines on its stdin, spawned once
+    # and fed through the same pipe for every change
+    def __init__(self, command=('xob', '-s', 'volume')):
+        self.command = command
+        self.process = None
+
+    async def notify(self, value: int, mute: bool, previous: int):
+        if self.process is None or self.process.returncode is not None:
+            self.process = await asyncio.create_subprocess_exec(
+                    *self.command, stdin=asyncio.subprocess.PIPE)
+        self.process.stdin.write(f"{value}{'!' if mute else ''}\n".encode())
+        await self.process.stdin.drain()
+
+    def close(self):
+        if self.process is not None and self.process.returncode is None:
+            self.process.stdin.close()
+#- VolumeXob
+
+async def volume(queue: StatusStore, frame=0.05, notifier=None):
+    import pulsectl_asyncio
+    # Status and raw status tags, and icon of the default sink and source
+    tags = {
+            'sink': ('volume', 'rawvolume', get_volume_icon),
+            'source': ('micvolume', 'rawmicvolume', get_mic_icon),
+            }
+    defaults = {}
+    current = {}
+    dirty = {'server'}
+    wake = asyncio.Event()
+    wake.set()
+
+    async with pulsectl_asyncio.PulseAsync('ui-statuses') as pulse:
+        info = {'sink': pulse.sink_info, 'source': pulse.source_info}
+
+        async def resolve():
+            # Default devices are given by name, look up their index once
+            # until the next server event
+            server_info = await pulse.server_info()
+            for facility, name, devices in [
+                    ('sink', server_info.default_sink_name, await pulse.sink_list()),
+                    ('source', server_info.default_source_name, await pulse.source_list()),
+                    ]:
+                defaults[facility] = next(
+                        (device.index for device in devices if device.name == name),
+                        None,
+                        )
+
+        async def refresh():
+            nonlocal dirty, notifier
+            while True:
+                await wake.wait()
+                wake.clear()
+                facilities, dirty = dirty, set()
+                if 'server' in facilities:
+                    await resolve()
+                    facilities.update(tags)
+                for facility in tags:
+                    index = defaults.get(facility)
+                    if facility not in facilities or index is None:
+                        continue
+                    try:
+                        device = await info[facility](index)
+                    except pulsectl_asyncio.PulseIndexError:
+                        # Removed meanwhile, the server event will follow
+                        continue
+                    value = round(device.volume.value_flat * 100)
+                    mute = device.mute == 1
+                    previous = current.get(facility)
+                    if previous != (value, mute):
+                        current[facility] = value, mute
+                        tag, raw_tag, get_icon = tags[facility]
+                        queue.put_nowait((raw_tag, '', str(value) + ('!' if mute else '')))
+                        queue.put_nowait((tag, get_icon(value, mute), f'{value: 3d}%'))
+                        # Changes only, not the initial volume
+                        if facility == 'sink' and previous and notifier is not None:
+                            try:
+                                await notifier.notify(value, mute, previous[0])
+                            except Exception as e:
+                                # The statuses go on without notifications
+                                print(f'volume: notification failed: {e}', file=sys.stderr, flush=True)
+                                notifier = None
+                # At most one update per frame, the events received meanwhile
+                # (e.g. a held volume key) are applied together
+                await asyncio.sleep(frame)
+
+        async def listen():
+            async for event in pulse.subscribe_events('server', 'sink', 'source'):
+                if event.facility == 'server':
+                    dirty.add('server')
+                else:
+                    facility = 'sink' if event.facility == 'sink' else 'source'
+                    if event.index != defaults.get(facility):
+                        continue
+                    dirty.add('server' if event.t == 'remove' else facility)
+                wake.set()
+
+        # Whichever stops first stops the other, the volume would freeze
+        # otherwise
+        refresher = asyncio.create_task(refresh())
+        listener = asyncio.create_task(listen())
+        try:
+            done, _ = await asyncio.wait(
+                    [refresher, listener], return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        except Exception as e:
+            print(f'volume: {e!r}, stopped', file=sys.stderr, flush=True)
+            raise
+        finally:
+            refresher.cancel()
+            listener.cancel()
+            if notifier is not None:
+                notifier.close()
 
 __service__ = 'org.mpris.MediaPlayer2'
 __object__ = '/org/mpris/MediaPlayer2'
 __interface__ = 'org.mpris.MediaPlayer2'
-
-bus = SessionBus()
+__player__ = 'org.mpris.MediaPlayer2.Player'
+__properties__ = 'org.freedesktop.DBus.Properties'
 
 
 class SafeDict(dict):
@@ -70,44 +263,61 @@ class SafeDict(dict):
         return None
 
 
+def unwrap(value):
+    from dbus_next import Variant
+    # Metadata values are variants themselves
+    if isinstance(value, Variant):
+        return unwrap(value.value)
+    if isinstance(value, dict):
+        return {key: unwrap(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [unwrap(item) for item in value]
+    return value
+
+
 class Player:
     def __init__(self, bus_name, owner):
         self.bus_name = bus_name
         self.name = bus_name.split('.')[3]
         self.owner = owner
         self.disconnecting = False
-        self.proxy = None
-        self.connect()
         self.properties = SafeDict()
-        self.properties['PlaybackStatus'] = self.proxy.PlaybackStatus
-        self.properties['Metadata'] = self.proxy.Metadata
-        self.properties['Volume'] = self.proxy.Volume
-
-    def refreshStatus(self):
-        # Some clients (VLC) will momentarily create a new player before
-        # removing it again so we can't be sure the interface still exists
-        self.properties['PlaybackStatus'] = self.proxy.PlaybackStatus
-
-    def refreshMetadata(self):
-        # Some clients (VLC) will momentarily create a new player before
-        #  removing it again so we can't be sure the interface still exists
-        self.properties['Metadata'] = self.proxy.Metadata
-
-    def connect(self):
-        self.disconnecting = False
-        self.proxy = bus.get(self.bus_name, __object__)
+        # Position in the listener's priority index, and rendered status
+        self.key = None
+        self.rendered = None
+
+    async def refresh(self, bus) -> bool:
+        from dbus_next import Message, MessageType
+        # Fetch all the properties in one round-trip. Some clients (VLC) will
+        # momentarily create a new player before removing it again so we
+        # can't be sure the interface still exists
+        reply = await bus.call(
+                Message(
+                    destination=self.owner,
+                    path=__object__,
+                    interface=__properties__,
+                    member='GetAll',
+                    signature='s',
+                    body=[__player__],
+                    )
+                )
+        if reply.message_type != MessageType.METHOD_RETURN:
+            return False
+        self.properties.update(unwrap(reply.body[0]))
+        self.rendered = None
+        return True
 
     def disconnect(self):
         self.disconnecting = True
-        self.proxy = None
 
     @property
     def Metadata(self):
-        return self.properties['Metadata']
+        return self.properties['Metadata'] or {}
 
     @Metadata.setter
     def Metadata(self, metadata):
         self.properties['Metadata'] = metadata
+        self.rendered = None
 
     @property
     def PlaybackStatus(self):
@@ -116,6 +326,7 @@ class Player:
     @PlaybackStatus.setter
     def PlaybackStatus(self, status):
         self.properties['PlaybackStatus'] = status
+        self.rendered = None
 
     @property
     def Volume(self):
@@ -139,176 +350,235 @@ class Player:
 
 
 class MprisListener():
-    def __init__(self, blacklist=[]):
+    # Everything runs on the asyncio loop, signals included
+    rules = [
+            f"type='signal',sender='org.freedesktop.DBus',member='NameOwnerChanged',arg0namespace='{__service__}'",
+            f"type='signal',path='{__object__}',member='Seeked'",
+            f"type='signal',path='{__object__}',interface='{__properties__}',member='PropertiesChanged'",
+            f"type='signal',path='{__object__}',member='TrackMetadataChanged'",
+            ]
+    # Playing players come first, then paused ones, the most recent first
+    ranks = {'Playing': 2, 'Paused': 1}
+
+    def __init__(self, blacklist=[], stats=None):
         self.blacklist = blacklist[:]
         self.players = {}
+        # (rank, owner number, owner) of every player, in ascending order so
+        # that the status owner is the last one
+        self.ranking = []
         self.last_status = None
         self.status_owner = None
         self.connected = False
-        self.subscriptions = []
-
-    def connect(self):
-        self.initializePlayerList()
-        self.subscriptions.append(
-                bus.subscribe(
-                    signal='NameOwnerChanged',
-                    signal_fired=self.on_name_owner_changed,
-                    )
-                )
-        self.subscriptions.append(
-                bus.subscribe(
-                    object=__object__,
-                    signal='Seeked',
-                    signal_fired=self.on_seeked,
+        self.stats = stats
+        self.bus = None
+        self.tasks = set()
+        self.handlers = {
+                'NameOwnerChanged': self.handler('NameOwnerChanged', self.on_name_owner_changed),
+                'Seeked': self.handler('Seeked', self.on_seeked),
+                'PropertiesChanged': self.handler('PropertiesChanged', self.on_properties_changed),
+                'TrackMetadataChanged': self.handler('TrackMetadataChanged', self.on_track_metadata_changed),
+                }
+
+    def handler(self, signal, callback):
+        if self.stats is None:
+            return callback
+        return self.stats.timed(self.stats.callbacks, signal, callback)
+
+    def spawn(self, function, *args):
+        # Keep a reference to background tasks until they are done
+        task = asyncio.create_task(function(*args))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def call_bus(self, member, signature='', body=[]):
+        from dbus_next import Message, MessageType
+        reply = await self.bus.call(
+                Message(
+                    destination='org.freedesktop.DBus',
+                    path='/org/freedesktop/DBus',
+                    interface='org.freedesktop.DBus',
+                    member=member,
+                    signature=signature,
+                    body=body,
                     )
                 )
-        self.subscriptions.append(
-                bus.subscribe(
-                    object=__object__,
-                    signal='PropertiesChanged',
-                    signal_fired=self.on_properties_changed,
-                    )
-                )
-        try:
-            subscription = bus.subscribe(
-                    object=__object__,
-                    signal='TrackMetadataChanged',
-                    signal_fired=self.on_track_metadata_changed,
-                    )
-            self.subscriptions.append(subscription)
-        except AttributeError:
-            pass
+        if reply.message_type != MessageType.METHOD_RETURN:
+            raise RuntimeError(f'{member}: {reply.body}')
+        return reply.body
+
+    async def connect(self):
+        # No session bus is needed until a player is watched
+        from dbus_next.aio import MessageBus
+        self.bus = await MessageBus().connect()
+        self.bus.add_message_handler(self.on_message)
+        await asyncio.gather(*[self.call_bus('AddMatch', 's', [rule]) for rule in self.rules])
+        await self.initializePlayerList()
 
     def disconnect(self):
         for owner in self.players:
             self.players[owner].disconnect()
-        for subscription in self.subscriptions:
-            subscription.unsubscribe()
+        if self.bus is not None:
+            self.bus.disconnect()
         self.connected = False
 
+    def on_message(self, message):
+        from dbus_next import MessageType
+        if message.message_type != MessageType.SIGNAL:
+            return
+        handler = self.handlers.get(message.member)
+        if handler is not None:
+            handler(message.sender, message.path, message.interface, message.member, message.body)
+
     def on_name_owner_changed(self, sender, path, iface, signal, params):
         bus_name, old_owner, new_owner = params
         if self.busNameIsAPlayer(bus_name):
-            time.sleep(0.5)
-            if new_owner and not old_owner:
-                need_update = self.addPlayer(bus_name, new_owner)
-            elif old_owner and not new_owner:
-                need_update = self.removePlayer(old_owner)
-            else:
-                need_update = self.changePlayerOwner(bus_name, old_owner, new_owner)
-            if need_update:
-                self.refreshStatus()
+            self.spawn(self.nameOwnerChanged, bus_name, old_owner, new_owner)
+
+    async def nameOwnerChanged(self, bus_name, old_owner, new_owner):
+        if new_owner and not old_owner:
+            need_update = await self.addPlayer(bus_name, new_owner)
+        elif old_owner and not new_owner:
+            need_update = self.removePlayer(old_owner)
+        else:
+            need_update = await self.changePlayerOwner(bus_name, old_owner, new_owner)
+        if need_update:
+            # Some clients (VLC) will momentarily create a new player before
+            # removing it again, let them settle until the end of the frame
+            self.refreshStatus(defer=True)
 
     def on_track_metadata_changed(self, sender, path, iface, signal, params):
-        track_id, metadata = params
-        player = self.players[sender]
-        name = player.name
-        owner = player.owner
-        try:
-            player.refreshMetadata()
-            if player.owner == self.getStatusOwner():
+        if sender in self.players:
+            self.spawn(self.refreshPlayer, self.players[sender])
+
+    async def refreshPlayer(self, player):
+        previous = self.status_owner
+        if await player.refresh(self.bus) and player.owner in self.players:
+            self.index(player)
+            if player.owner in (previous, self.getStatusOwner()):
                 self.refreshStatus()
-        except AttributeError:
-            pass
 
     def on_seeked(self, sender, path, iface, signal, params):
         position = params
-        player = self.players[sender]
-        if player.owner == self.getStatusOwner():
+        player = self.players.get(sender)
+        if player is not None and player.owner == self.getStatusOwner():
             self.refreshStatus()
 
     def on_properties_changed(self, sender, path, iface, signal, params):
-        interface, properties, signature = params
-        player = self.players[sender]
+        interface, properties, invalidated = params
+        player = self.players.get(sender)
+        if player is None:
+            return
+        properties = unwrap(properties)
+        previous = self.status_owner
         updated = False
-        if 'Metadata'in properties:
+        if 'Metadata' in properties:
             if properties['Metadata'] != player.Metadata:
                 player.Metadata = properties['Metadata']
                 updated = True
         if 'PlaybackStatus' in properties:
             if properties['PlaybackStatus'] != player.PlaybackStatus:
                 player.PlaybackStatus = properties['PlaybackStatus']
+                self.index(player)
                 updated = True
         if 'Volume' in properties:
             if properties['Volume'] != player.Volume:
                 player.Volume = properties['Volume']
                 updated = True
         if updated:
-            if player.owner == self.getStatusOwner():
+            # Also refresh when the player just lost the status to another
+            if player.owner in (previous, self.getStatusOwner()):
                 self.refreshStatus()
 
     def busNameIsAPlayer(self, bus_name):
         return bus_name.startswith(__service__) and bus_name.split('.')[3] not in self.blacklist
 
-    def initializePlayerList(self):
-        bus_names = [bus_name for bus_name in bus.dbus.ListNames()
-                if self.busNameIsAPlayer(bus_name)]
-        for bus_name in bus_names:
-            owner = bus.dbus.GetNameOwner(bus_name)
-            self.addPlayer(bus_name, owner=owner)
+    async def initializePlayerList(self):
+        names, = await self.call_bus('ListNames')
+        bus_names = [bus_name for bus_name in names if self.busNameIsAPlayer(bus_name)]
+        # Query all the players at once
+        owners = await asyncio.gather(
+                *[self.call_bus('GetNameOwner', 's', [bus_name]) for bus_name in bus_names],
+                return_exceptions=True,
+                )
+        await asyncio.gather(*[
+                self.addPlayer(bus_name, owner=owner[0])
+                for bus_name, owner in zip(bus_names, owners)
+                if not isinstance(owner, Exception)
+                ])
         if self.connected != True:
             self.connected = True
             self.refreshStatus()
 
-    def addPlayer(self, bus_name, owner = None) -> bool:
-        self.players[owner] = Player(bus_name, owner)
+    async def addPlayer(self, bus_name, owner = None) -> bool:
+        player = Player(bus_name, owner)
+        if not await player.refresh(self.bus):
+            # Already gone
+            return False
+        if owner in self.players:
+            self.unindex(self.players[owner])
+        self.players[owner] = player
+        self.index(player)
         return self.getStatusOwner() == owner
 
     def removePlayer(self, owner) -> bool:
         if owner in self.players:
             self.players[owner].disconnect()
-            del self.players[owner]
+            self.unindex(self.players.pop(owner))
             return True
         return False
 
-    def changePlayerOwner(self, bus_name, old_owner, new_owner):
+    # Move a player in the priority index after its status changed, a
+    # bisection instead of sorting all the players again
+    def index(self, player):
+        key = (
+                self.ranks.get(player.PlaybackStatus, 0),
+                int(player.owner.split('.')[-1]),
+                player.owner,
+                )
+        if key != player.key:
+            self.unindex(player)
+            insort(self.ranking, key)
+            player.key = key
+
+    def unindex(self, player):
+        if player.key is not None:
+            del self.ranking[bisect_left(self.ranking, player.key)]
+            player.key = None
+
+    async def changePlayerOwner(self, bus_name, old_owner, new_owner):
         updated = False
         if self.removePlayer(old_owner):
             updated = True
-        if self.addPlayer(bus_name, new_owner):
+        if await self.addPlayer(bus_name, new_owner):
             updated = True
         return updated
 
     # Get a list of player owners sorted by current status and age
     def getSortedPlayerOwnerList(self):
-        players = [
-                {
-                    'number': int(owner.split('.')[-1]),
-                    'status': 2 if player.PlaybackStatus == 'Playing' else 1 if player.PlaybackStatus == 'paused' else 0,
-                    'owner': owner,
-                    }
-                for owner, player in self.players.items()
-                ]
-        return [info['owner'] for info in reversed(sorted(players, key=itemgetter('status', 'number')))]
+        return [owner for _, _, owner in reversed(self.ranking)]
 
     # Get status owner
     def getStatusOwner(self):
-        if len(self.players):
-            sorted_owners = self.getSortedPlayerOwnerList()
-            playing_players = [
-                    owner for owner in sorted_owners
-                    if self.players[owner].PlaybackStatus == 'Playing' or
-                    self.players[owner].PlaybackStatus == 'Paused'
-                    ]
-            self.status_owner = playing_players[0] \
-                    if playing_players else sorted_owners[0]
-        else:
-            self.status_owner = None
+        self.status_owner = self.ranking[-1][2] if self.ranking else None
         return self.status_owner
 
-    def refreshStatus(self):
+    def refreshStatus(self, defer=False):
         raise NotImplementedError
 
 
 class MprisListenerAsync(MprisListener):
-    def __init__(self, queue: asyncio.Queue, blacklist=[]):
-        super().__init__(blacklist)
+    def __init__(self, queue: StatusStore, blacklist=[], stats=None, frame=0.05):
+        super().__init__(blacklist, stats=stats)
         self.queue = queue
+        # Refreshes are coalesced: at most one status computation per frame,
+        # the last one at the end of the frame
+        self.frame = frame
+        self.flushed = -math.inf
+        self.pending = None
 
     async def run(self):
-        self.connect()
-        while self.connected:
-            await asyncio.sleep(5)
+        await self.connect()
+        await self.bus.wait_for_disconnect()
 
     def getStatus(self):
         if len(self.players):
@@ -317,12 +587,26 @@ class MprisListenerAsync(MprisListener):
         else:
             return ICON_STOPPED, ''
 
-    def refreshStatus(self):
+    def refreshStatus(self, defer=False):
+        if self.pending is not None:
+            # Already due at the end of the frame
+            return
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        delay = self.frame if defer else self.flushed + self.frame - now
+        if delay > 0:
+            self.pending = loop.call_later(delay, self.flushStatus)
+        else:
+            self.flushStatus()
+
+    def flushStatus(self):
         #  if len(self.players):
         #      owner = self.getStatusOwner()
         #      self.queue.put_nowait(('mpris', *self.playerStatus(owner)))
         #  else:
         #      self.queue.put_nowait(('mpris', ICON_STOPPED, ''))
+        self.pending = None
+        self.flushed = asyncio.get_running_loop().time()
         status = self.getStatus()
         if status != self.last_status:
             self.last_status = status
@@ -330,7 +614,13 @@ class MprisListenerAsync(MprisListener):
             #  print(*status, flush=True)
 
     def playerStatus(self, owner: str):
+        # Only render again after the status or the metadata changed
         player = self.players[owner]
+        if player.rendered is None:
+            player.rendered = self.renderStatus(player)
+        return player.rendered
+
+    def renderStatus(self, player: Player):
         nowplaying = ''
         icon = {
                 'Playing': ICON_PLAYING,
@@ -359,14 +649,17 @@ class MprisListenerAsync(MprisListener):
         return icon, nowplaying
 
 
-async def mpris(queue: asyncio.Queue):
-    # Requires a running glib mainloop
+async def mpris(queue: StatusStore, stats=None, frame=0.05):
     try:
-        listener = MprisListenerAsync(queue, BLACKLIST)
+        listener = MprisListenerAsync(queue, BLACKLIST, stats=stats, frame=frame)
         task = asyncio.create_task(listener.run())
         await task
     except KeyboardInterrupt:
         listener.disconnect()
+    except Exception as e:
+        # e.g. no session bus on a headless host
+        print(f'mpris: {e!r}, stopped', file=sys.stderr, flush=True)
+        raise
 
 #  async def mpris(queue: asyncio.Queue):
 #      # Create the subprocess; redirect the standard output into a pipe.
@@ -408,117 +701,1534 @@ async def mpris(queue: asyncio.Queue):
 #      # Wait for the subprocess exit.
 #      await proc.wait()
 
-async def cpupercent(queue: asyncio.Queue):
-    idle = 0
-    total = 0
-    while True:
-        #  async with aiofiles.open('/proc/stat', mode='r') as f:
-        #      line = await f.readline()
-        with open('/proc/stat') as f:
-            line = f.readline()
-        tokens = line.split()
-        cur_total = sum(map(int, tokens[1:]))
-        cur_idle = int(tokens[4])
-        percent = 1 - ( (cur_idle - idle) / (cur_total - total))
-        queue.put_nowait(('cpupercent', '', f'{percent: 3.0%}'))
-        idle = cur_idle
-        total = cur_total
-        await asyncio.sleep(1)
-
-async def loadavg(queue: asyncio.Queue):
-    while True:
-        #  async with aiofiles.open('/proc/loadavg', mode='r') as f:
-        #      line = await f.readline()
-        with open('/proc/loadavg') as f:
-            line = f.readline()
-        tokens = line.split()
-        queue.put_nowait(('loadavg', '', '{} {} {}'.format(*tokens[:3])))
-        await asyncio.sleep(10)
-
-async def mempercent(queue: asyncio.Queue):
-    while True:
-        #  async with aiofiles.open('/proc/meminfo', mode='r') as f:
-        #      async for line in f:
-        with open('/proc/meminfo') as f:
-            for line in f:
-                if line.startswith('Mem'):
-                    if line.startswith('MemTotal'):
-                        memtotal = int(line.split()[1])
-                    elif line.startswith('MemAvailable'):
-                        memavailable = int(line.split()[1])
-                elif line.startswith('Swap'):
-                    if line.startswith('SwapTotal'):
-                        swaptotal = int(line.split()[1])
-                    elif line.startswith('SwapFree'):
-                        swapfree = int(line.split()[1])
-                        break
+# Where collectors read system statistics from, may be a fake procfs
+PROC_ROOT = '/proc'
+# Where sensors are discovered, may be a fake sysfs
+SYS_ROOT = '/sys'
+
+
+class ProcFile:
+    # Keep a /proc file open and read it again from the start into the same
+    # buffer, instead of opening, reading and decoding it on every sample.
+    # Path is relative to PROC_ROOT, or to root (e.g. SYS_ROOT).
+    def __init__(self, path: str, size: int = 4096, root: str = None):
+        path = os.path.join(PROC_ROOT if root is None else root, path)
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+        self.buffer = bytearray(size)
+        self.length = 0
+
+    def read(self) -> bytearray:
+        length = os.preadv(self.fd, [self.buffer], 0)
+        while length == len(self.buffer):
+            # Buffer too small to hold the whole file
+            self.buffer = bytearray(2 * len(self.buffer))
+            length = os.preadv(self.fd, [self.buffer], 0)
+        self.length = length
+        return self.buffer
+
+    def close(self):
+        os.close(self.fd)
+#- ProcFile
+
+
+class MemInfo(ProcFile):
+    # Offsets of the keys are found once, then only checked on each read
+    def __init__(self, keys, path='meminfo'):
+        super().__init__(path)
+        self.keys = [f'{key}:'.encode() for key in keys]
+        self.offsets = {}
+
+    def find(self, key: bytes) -> int:
+        if self.buffer.startswith(key):
+            offset = 0
+        else:
+            offset = self.buffer.index(b'\n' + key, 0, self.length) + 1
+        self.offsets[key] = offset
+        return offset
+
+    def values(self):
+        buffer = self.read()
+        for key in self.keys:
+            offset = self.offsets.get(key)
+            if offset is None or not buffer.startswith(key, offset):
+                offset = self.find(key)
+            start = offset + len(key)
+            yield int(buffer[start:buffer.index(b' kB', start)])
+#- MemInfo
+
+
+# Formats of the numeric statuses, also used for their history
+PERCENT = '{: 3.0%}'.format
+SPEED = '{: 4.1f} KiB/s'.format
+THROUGHPUT = '{: 4.1f} MiB/s'.format
+IOPS = '{: 4.0f} IO/s'.format
+MIB = '{: 3.0f} MiB'.format
+LOAD = '{:.2f}'.format
+TEMP = '{: 3.0f}°C'.format
+FAN = '{: 4.0f} RPM'.format
+
+
+class Ring:
+    # Last samples of a metric as float32, with the aggregates updated on
+    # each sample instead of computed over the window: running sum for the
+    # mean, monotonic queues of (sequence, value) for the minimum and the
+    # maximum, and the sparkline of the last samples
+    __slots__ = ('values', 'sequence', 'total', 'ewma', 'minima', 'maxima', 'scale', 'spark')
+
+    def __init__(self, size: int):
+        self.values = array('f', bytes(4 * size))
+        self.sequence = 0
+        self.total = 0.0
+        self.ewma = None
+        self.minima = deque()
+        self.maxima = deque()
+        self.scale = None
+        self.spark = ''
+
+    def __len__(self):
+        return min(self.sequence, len(self.values))
+
+    def append(self, value: float, alpha: float):
+        size = len(self.values)
+        index = self.sequence % size
+        if self.sequence >= size:
+            self.total -= self.values[index]
+        self.values[index] = value
+        # Aggregate the stored value, rounded to float32, so that it can be
+        # subtracted again exactly
+        value = self.values[index]
+        self.total += value
+        self.ewma = value if self.ewma is None else self.ewma + alpha * (value - self.ewma)
+        expired = self.sequence - size
+        while self.minima and self.minima[-1][1] >= value:
+            self.minima.pop()
+        self.minima.append((self.sequence, value))
+        if self.minima[0][0] <= expired:
+            self.minima.popleft()
+        while self.maxima and self.maxima[-1][1] <= value:
+            self.maxima.pop()
+        self.maxima.append((self.sequence, value))
+        if self.maxima[0][0] <= expired:
+            self.maxima.popleft()
+        self.sequence += 1
+
+    @property
+    def minimum(self):
+        return self.minima[0][1]
+
+    @property
+    def maximum(self):
+        return self.maxima[0][1]
+
+    @property
+    def mean(self):
+        return self.total / len(self)
+
+    def level(self, value: float, ramp: str) -> str:
+        position = int(value / self.scale * len(ramp)) if self.scale > 0 else 0
+        return ramp[min(max(position, 0), len(ramp) - 1)]
+
+    def sparkline(self, width: int, ramp: str) -> str:
+        # Drawn relative to the maximum of the window: only the new sample
+        # is added, unless the maximum changed
+        if self.scale == self.maximum and len(self.spark) == min(width, len(self)):
+            self.spark = self.spark[1:] + self.level(self.values[(self.sequence - 1) % len(self.values)], ramp)
+        else:
+            self.scale = self.maximum
+            count = min(width, len(self))
+            self.spark = ''.join(
+                    self.level(self.values[sequence % len(self.values)], ramp)
+                    for sequence in range(self.sequence - count, self.sequence)
+                    )
+        return self.spark
+#- Ring
+
+
+class History:
+    # Rolling history of the numeric statuses matching the patterns, each
+    # published again as derived statuses: tag.spark, tag.min, tag.max,
+    # tag.mean and tag.ewma
+    ramp = '▁▂▃▄▅▆▇█'
+
+    def __init__(self, size=60, width=10, patterns=None, alpha=0.2):
+        self.size = size
+        self.width = width
+        self.patterns = patterns or ['*']
+        self.alpha = alpha
+        # Tag -> Ring, or None when not kept
+        self.rings = {}
+
+    def ring(self, tag: str):
+        if tag not in self.rings:
+            selected = any(fnmatch(tag, pattern) for pattern in self.patterns)
+            self.rings[tag] = Ring(self.size) if selected else None
+        return self.rings[tag]
+
+    def record(self, sampler, tag: str, value: float, format):
+        ring = self.ring(tag)
+        if ring is None:
+            return
+        ring.append(value, self.alpha)
+        sampler.put(f'{tag}.spark', '', ring.sparkline(self.width, self.ramp))
+        sampler.put(f'{tag}.min', '', format(ring.minimum))
+        sampler.put(f'{tag}.max', '', format(ring.maximum))
+        sampler.put(f'{tag}.mean', '', format(ring.mean))
+        sampler.put(f'{tag}.ewma', '', format(ring.ewma))
+#- History
+
+
+HISTORY = None
+
+
+class Sampler:
+    # Periodic collector run by the TickScheduler: interval in seconds, and
+    # how early it may run to share a tick with other samplers
+    interval = 1
+    slack = 0
+    adaptive = True
+
+    def __init__(self, queue: StatusStore):
+        self.queue = queue
+        # The scheduler may change the interval in adaptive mode
+        self.base_interval = self.interval
+        self.statuses = {}
+        self.changed = False
+        self.stable = 0
+        self.suspended = False
+
+    @property
+    def name(self):
+        return type(self).__name__.lower()
+
+    def put(self, tag: str, icon: str, output: str):
+        # Only changed statuses are worth sending to the consumer
+        if self.statuses.get(tag) != (icon, output):
+            self.statuses[tag] = (icon, output)
+            self.changed = True
+            self.queue.put_nowait((tag, icon, output))
+
+    def put_value(self, tag: str, icon: str, value: float, format):
+        self.put(tag, icon, format(value))
+        self.record(tag, value, format)
+
+    def record(self, tag: str, value: float, format):
+        if HISTORY is not None:
+            HISTORY.record(self, tag, value, format)
+
+    def sample(self):
+        raise NotImplementedError
+#- Sampler
+
+
+class CpuPercent(Sampler):
+    interval = 1
+    # Counters summed into the total time: user nice system idle iowait irq
+    # softirq steal. Guest time is already accounted in user and nice.
+    columns = 8
+    ramp = '▁▂▃▄▅▆▇█'
+
+    def __init__(self, queue: StatusStore, detail: bool = False):
+        super().__init__(queue)
+        self.detail = detail
+        self.stat = ProcFile('stat', size=16384)
+        buffer = self.stat.read()
+        # Width of the cpu lines, name included
+        self.width = len(buffer[:buffer.index(b'\n')].split())
+        self.names = []
+        self.counters = array('q')
+
+    def read(self):
+        # Parse all the cpu lines at once into a flat CPU x counter matrix,
+        # the first row being the aggregate of all CPUs
+        buffer = self.stat.read()
+        if self.detail:
+            last = buffer.rindex(b'\ncpu', 0, self.stat.length)
+            end = buffer.index(b'\n', last + 1)
+        else:
+            end = buffer.index(b'\n')
+        tokens = buffer[:end].split()
+        names = tokens[::self.width]
+        del tokens[::self.width]
+        return names, array('q', map(int, tokens))
+
+    @staticmethod
+    def ratio(part, total):
+        return part / total if total else 0
+
+    def sample(self):
+        names, counters = self.read()
+        if names != self.names:
+            # CPUs went online or offline
+            self.names = names
+            self.counters = array('q', [0]) * len(counters)
+        # Deltas of the whole matrix, then one array per counter column
+        deltas = array('q', map(sub, counters, self.counters))
+        self.counters = counters
+        width = self.width - 1
+        columns = [deltas[column::width] for column in range(width)]
+        totals = columns[0]
+        for column in columns[1:self.columns]:
+            totals = array('q', map(add, totals, column))
+        idle = list(map(self.ratio, columns[3], totals))
+        busy = [1 - value for value in idle]
+        self.put_value('cpupercent', '', busy[0], PERCENT)
+        if not self.detail:
+            return
+        for name, value in zip(names[1:], busy[1:]):
+            self.put_value(name.decode(), '', value, PERCENT)
+        ramp = self.ramp
+        bars = ''.join(ramp[min(int(value * len(ramp)), len(ramp) - 1)]
+                for value in busy[1:])
+        self.put('cpubars', '', bars)
+        total = totals[0]
+        states = {
+                'cpuuser': columns[0][0] + columns[1][0],
+                'cpusystem': columns[2][0],
+                'cpuiowait': columns[4][0],
+                'cpuirq': columns[5][0] + columns[6][0],
+                'cpusteal': columns[7][0] if width > 7 else 0,
+                }
+        for tag, value in states.items():
+            self.put_value(tag, '', self.ratio(value, total), PERCENT)
+#- CpuPercent
+
+
+class LoadAvg(Sampler):
+    interval = 10
+
+    def __init__(self, queue: StatusStore):
+        super().__init__(queue)
+        self.loadavg = ProcFile('loadavg', size=128)
+
+    def sample(self):
+        buffer = self.loadavg.read()
+        # The three load averages come first, separated by single spaces
+        end = buffer.index(b' ')
+        end = buffer.index(b' ', end + 1)
+        end = buffer.index(b' ', end + 1)
+        self.put('loadavg', '', buffer[:end].decode())
+        self.record('loadavg', float(buffer[:buffer.index(b' ')]), LOAD)
+#- LoadAvg
+
+
+class MemPercent(Sampler):
+    interval = 5
+
+    def __init__(self, queue: StatusStore):
+        super().__init__(queue)
+        self.meminfo = MemInfo(['MemTotal', 'MemAvailable', 'SwapTotal', 'SwapFree'])
+
+    def sample(self):
+        memtotal, memavailable, swaptotal, swapfree = self.meminfo.values()
         mempercent = (memtotal - memavailable) / memtotal
-        queue.put_nowait(('mempercent', '', f'{mempercent: 3.0%}'))
+        self.put_value('mempercent', '', mempercent, PERCENT)
         swapused = (swaptotal - swapfree) / 1024
-        queue.put_nowait(('swapused', '', f'{swapused: 3.0f} MiB'))
-        await asyncio.sleep(5)
+        self.put_value('swapused', '', swapused, MIB)
+#- MemPercent
 
-async def netspeed(queue: asyncio.Queue):
-    downbytes = 0
-    upbytes = 0
-    while True:
-        with open('/proc/net/dev') as f:
-            for line in f:
-                tokens = line.split()
-                if tokens[0].endswith(':') and tokens[0] != 'lo:':
-                    device = tokens[0].strip(':')
-                    down = int(tokens[1])
-                    up = int(tokens[9])
-                    downspeed = (down - downbytes) / 1024
-                    downtotal = down / 1024 / 1024
-                    upspeed = (up - upbytes) / 1024
-                    uptotal = up / 1024 / 1024
-                    downbytes = down
-                    upbytes = up
-                    break
-        queue.put_nowait(('device', '', device))
-        queue.put_nowait(('downspeed', '', f'{downspeed: 4.1f} KiB/s'))
-        queue.put_nowait(('downtotal', '', f'{downtotal: 4.1f} MiB'))
-        queue.put_nowait(('upspeed', '', f'{upspeed: 4.1f} KiB/s'))
-        queue.put_nowait(('uptotal', '', f'{uptotal: 4.1f} MiB'))
-        await asyncio.sleep(1)
-
-async def consumer(root: str, queue: asyncio.Queue):
-    def write_status(tag: str, icon: str, output: str):
-        dest = os.path.join(root, tag)
-        if icon:
-            output = f'{icon} {output}'
-        with open(dest, mode='w') as f:
-            f.write(f'{output}')
+
+class NetSpeed(Sampler):
+    interval = 1
+    # Loopback, bridges, container and VM links, tunnels and VPNs: their
+    # traffic also goes through a physical interface, or never leaves
+    virtual = [
+            'lo', 'br*', 'docker*', 'veth*', 'virbr*', 'vnet*',
+            'tun*', 'tap*', 'wg*', 'ifb*',
+            ]
+
+    def __init__(self, queue: StatusStore, include=None, exclude=None):
+        super().__init__(queue)
+        self.netdev = ProcFile('net/dev')
+        self.include = include or ['*']
+        self.exclude = self.virtual if exclude is None else exclude
+        # Interface name as read from /proc/net/dev -> decoded name, or None
+        # when filtered out
+        self.devices = {}
+        # Interface name -> received and transmitted bytes
+        self.counters = {}
+        self.time = None
+
+    def select(self, name: bytes):
+        if name not in self.devices:
+            device = name.decode()
+            selected = any(fnmatch(device, pattern) for pattern in self.include) \
+                    and not any(fnmatch(device, pattern) for pattern in self.exclude)
+            self.devices[name] = device if selected else None
+        return self.devices[name]
+
+    def read(self):
+        buffer = self.netdev.read()
+        counters = {}
+        # Skip the two header lines
+        start = buffer.index(b'\n', buffer.index(b'\n') + 1) + 1
+        while start < self.netdev.length:
+            end = buffer.index(b'\n', start)
+            colon = buffer.index(b':', start, end)
+            device = self.select(bytes(buffer[start:colon].strip()))
+            if device is not None:
+                tokens = buffer[colon + 1:end].split(None, 9)
+                counters[device] = (int(tokens[0]), int(tokens[8]))
+            start = end + 1
+        return counters
+
+    def sample(self):
+        now = time.monotonic()
+        elapsed = now - self.time if self.time is not None else 0
+        self.time = now
+        counters = self.read()
+        downspeed = upspeed = downtotal = uptotal = 0
+        for device, (down, up) in counters.items():
+            previous = self.counters.get(device)
+            if previous is not None and elapsed > 0:
+                # Counters are reset when the interface is recreated
+                down_rate = max(down - previous[0], 0) / elapsed / 1024
+                up_rate = max(up - previous[1], 0) / elapsed / 1024
+            else:
+                down_rate = up_rate = 0
+            self.put_value(f'downspeed@{device}', '', down_rate, SPEED)
+            self.put(f'downtotal@{device}', '', f'{down / 1024 / 1024: 4.1f} MiB')
+            self.put_value(f'upspeed@{device}', '', up_rate, SPEED)
+            self.put(f'uptotal@{device}', '', f'{up / 1024 / 1024: 4.1f} MiB')
+            downspeed += down_rate
+            upspeed += up_rate
+            downtotal += down / 1024 / 1024
+            uptotal += up / 1024 / 1024
+        self.counters = counters
+        self.put('device', '', ','.join(counters))
+        self.put_value('downspeed', '', downspeed, SPEED)
+        self.put('downtotal', '', f'{downtotal: 4.1f} MiB')
+        self.put_value('upspeed', '', upspeed, SPEED)
+        self.put('uptotal', '', f'{uptotal: 4.1f} MiB')
+#- NetSpeed
+
+
+class DiskIO(Sampler):
+    interval = 1
+    # Fields after the device name: reads completed, sectors read, writes
+    # completed, sectors written, and milliseconds spent doing I/O
+    fields = (0, 2, 4, 6, 9)
+    # Sectors are always 512 bytes in /proc/diskstats
+    sector = 512
+
+    def __init__(self, queue: StatusStore, include=None, exclude=None, stacked=False):
+        super().__init__(queue)
+        self.diskstats = ProcFile('diskstats', size=16384)
+        self.include = include or ['*']
+        self.exclude = ['loop*', 'ram*', 'zram*'] if exclude is None else exclude
+        self.stacked = stacked
+        # Device name as read from /proc/diskstats -> decoded name, or None
+        # when filtered out, a partition or a stacked device
+        self.devices = {}
+        # Device name -> counters
+        self.counters = {}
+        self.time = None
+
+    @staticmethod
+    def is_partition(device: str) -> bool:
+        return os.path.exists(os.path.join(SYS_ROOT, 'class/block', device, 'partition'))
+
+    @staticmethod
+    def is_stacked(device: str) -> bool:
+        # Device-mapper (LUKS, LVM) and md devices, their I/O is also counted
+        # on the disks below them
+        try:
+            return bool(os.listdir(os.path.join(SYS_ROOT, 'class/block', device, 'slaves')))
+        except OSError:
+            return False
+
+    def select(self, name: bytes):
+        if name not in self.devices:
+            device = name.decode()
+            selected = any(fnmatch(device, pattern) for pattern in self.include) \
+                    and not any(fnmatch(device, pattern) for pattern in self.exclude) \
+                    and not self.is_partition(device) \
+                    and (self.stacked or not self.is_stacked(device))
+            self.devices[name] = device if selected else None
+        return self.devices[name]
+
+    def read(self):
+        buffer = self.diskstats.read()
+        counters = {}
+        start = 0
+        while start < self.diskstats.length:
+            end = buffer.index(b'\n', start)
+            # major minor name counters...
+            tokens = buffer[start:end].split(None, 14)
+            device = self.select(bytes(tokens[2]))
+            if device is not None:
+                counters[device] = tuple(int(tokens[3 + field]) for field in self.fields)
+            start = end + 1
+        return counters
+
+    def sample(self):
+        now = time.monotonic()
+        elapsed = now - self.time if self.time is not None else 0
+        self.time = now
+        counters = self.read()
+        diskread = diskwrite = diskiops = diskutil = 0
+        for device, current in counters.items():
+            previous = self.counters.get(device)
+            if previous is not None and elapsed > 0:
+                reads, read, writes, written, busy = (
+                        max(value - last, 0)
+                        for value, last in zip(current, previous)
+                        )
+                read_rate = read * self.sector / elapsed / 1024 / 1024
+                write_rate = written * self.sector / elapsed / 1024 / 1024
+                iops = (reads + writes) / elapsed
+                util = min(busy / 1000 / elapsed, 1)
+            else:
+                read_rate = write_rate = iops = util = 0
+            self.put_value(f'diskread@{device}', '', read_rate, THROUGHPUT)
+            self.put_value(f'diskwrite@{device}', '', write_rate, THROUGHPUT)
+            self.put_value(f'diskiops@{device}', '', iops, IOPS)
+            self.put_value(f'diskutil@{device}', '', util, PERCENT)
+            diskread += read_rate
+            diskwrite += write_rate
+            diskiops += iops
+            # The busiest device is the one that stalls
+            diskutil = max(diskutil, util)
+        self.counters = counters
+        self.put('disks', '', ','.join(counters))
+        self.put_value('diskread', '', diskread, THROUGHPUT)
+        self.put_value('diskwrite', '', diskwrite, THROUGHPUT)
+        self.put_value('diskiops', '', diskiops, IOPS)
+        self.put_value('diskutil', '', diskutil, PERCENT)
+#- DiskIO
+
+
+class TopProc(Sampler):
+    # Processes using the most CPU time since the previous scan, and the
+    # most memory. Everything comes from /proc/[pid]/stat, that has the
+    # resident set size too, read with one open/read/close per process: no
+    # file is kept open as there may be thousands of them.
+    interval = 5
+
+    def __init__(self, queue: StatusStore, count: int = 3, interval=None):
+        if interval is not None:
+            self.interval = interval
+        super().__init__(queue)
+        self.count = count
+        self.proc = os.open(PROC_ROOT, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+        self.meminfo = MemInfo(['MemTotal'])
+        self.clock_ticks = os.sysconf('SC_CLK_TCK')
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+        self.cpus = os.cpu_count() or 1
+        # Pid -> start time and CPU time at the previous scan
+        self.processes = {}
+        self.time = None
+
+    def read(self, pid: str):
+        try:
+            fd = os.open(f'{pid}/stat', os.O_RDONLY | os.O_CLOEXEC, dir_fd=self.proc)
+            try:
+                buffer = os.read(fd, 4096)
+            finally:
+                os.close(fd)
+        except (FileNotFoundError, ProcessLookupError):
+            # Exited meanwhile
+            return None
+        # The command name may contain spaces and parentheses
+        end = buffer.rindex(b')')
+        name = buffer[buffer.index(b'(') + 1:end]
+        # Fields from the state on: utime and stime are 11 and 12, start time
+        # 19 and rss 21
+        fields = buffer[end + 2:].split(None, 22)
+        return name, int(fields[11]) + int(fields[12]), int(fields[19]), int(fields[21])
+
+    def publish(self, kind: str, top):
+        for rank in range(self.count):
+            status = f'{top[rank][0]}{PERCENT(top[rank][1])}' if rank < len(top) else ''
+            self.put(f'top{kind}{rank + 1}', '', status)
+        self.put(f'top{kind}', '', ', '.join(
+                f'{name}{PERCENT(share)}' for name, share in top))
+
+    def sample(self):
+        now = time.monotonic()
+        elapsed = now - self.time if self.time is not None else 0
+        self.time = now
+        previous = self.processes
+        processes = {}
+        cpu = []
+        memory = []
+        for entry in os.scandir(PROC_ROOT):
+            pid = entry.name
+            if not pid.isdigit():
+                continue
+            stat = self.read(pid)
+            if stat is None:
+                continue
+            name, cpu_time, start_time, rss = stat
+            # Pids of exited processes are not carried over
+            processes[pid] = (start_time, cpu_time)
+            last = previous.get(pid)
+            if last is not None and last[0] == start_time:
+                used = cpu_time - last[1]
+            else:
+                # Started since the previous scan, or its pid was reused.
+                # Everything is new on the first scan, nothing can be told.
+                used = cpu_time if elapsed else 0
+            cpu.append((used, name))
+            memory.append((rss, name))
+        self.processes = processes
+        capacity = elapsed * self.clock_ticks * self.cpus
+        self.publish('cpu', [
+                (name.decode(errors='replace'), used / capacity)
+                for used, name in nlargest(self.count, cpu)
+                ] if capacity else [])
+        memtotal, = self.meminfo.values()
+        self.publish('mem', [
+                (name.decode(errors='replace'), rss * self.page_size / 1024 / memtotal)
+                for rss, name in nlargest(self.count, memory)
+                ])
+#- TopProc
+
+
+class Pressure(Sampler):
+    # Pressure stall information: share of the time some tasks were stalled
+    # waiting for cpu, memory or io over the last 10 seconds (avg10).
+    #
+    # Instead of polling, a kernel trigger is registered on each resource:
+    # the kernel reports with POLLPRI when tasks stalled longer than the
+    # threshold within a window. Asyncio only polls for POLLIN, so the
+    # triggers are polled by an epoll instance of their own, itself
+    # readable when one of them fired. The sampler then runs at its fast
+    # interval as long as the pressure is high, then sleeps again.
+    #
+    # Unprivileged triggers need Linux 6.5: without them, the pressure is
+    # polled at the load average rate instead, and at the fast interval
+    # while high.
+    interval = 60
+    poll = 10
+    adaptive = False
+    resources = {'cpu': 'cpupressure', 'memory': 'mempressure', 'io': 'iopressure'}
+    # Unprivileged triggers need a window multiple of 2s
+    window = 2000000
+
+    def __init__(self, queue: StatusStore, threshold=0.1, fast=2):
+        super().__init__(queue)
+        self.threshold = threshold
+        self.fast = fast
+        self.files = {}
+        self.triggers = []
+        self.epoll = None
+        self.on_stall = None
+        for resource in self.resources:
+            try:
+                procfile = ProcFile(f'pressure/{resource}', size=256)
+            except OSError:
+                # No PSI in this kernel
+                continue
+            try:
+                procfile.read()
+            except OSError:
+                # Disabled (psi=0)
+                procfile.close()
+                continue
+            self.files[resource] = procfile
+        if not self.files:
+            raise FileNotFoundError(os.path.join(PROC_ROOT, 'pressure'))
+        self.arm()
+        if not self.triggers:
+            self.interval = self.base_interval = self.poll
+
+    def arm(self):
+        trigger = f'some {int(self.threshold * self.window)} {self.window}\0'.encode()
+        epoll = select.epoll()
+        for resource, procfile in self.files.items():
+            try:
+                fd = os.open(procfile.path, os.O_RDWR | os.O_NONBLOCK | os.O_CLOEXEC)
+            except OSError:
+                continue
+            try:
+                os.write(fd, trigger)
+                epoll.register(fd, select.EPOLLPRI)
+            except OSError:
+                # Not allowed to create triggers, or not a pollable file
+                # (e.g. a fake procfs)
+                os.close(fd)
+                continue
+            self.triggers.append(fd)
+        if not self.triggers:
+            epoll.close()
+            return
+        self.epoll = epoll
+        asyncio.get_running_loop().add_reader(epoll.fileno(), self.on_trigger)
+
+    def on_trigger(self):
+        # Reading the events resets the triggers
+        self.epoll.poll(0)
+        if self.on_stall is not None:
+            self.on_stall(self)
+
+    def read(self, resource: str) -> float:
+        buffer = self.files[resource].read()
+        # "some avg10=0.00 avg60=0.00 avg300=0.00 total=0"
+        start = buffer.index(b'avg10=') + 6
+        return float(buffer[start:buffer.index(b' ', start)]) / 100
+
+    def sample(self):
+        high = False
+        for resource, tag in self.resources.items():
+            if resource not in self.files:
+                continue
+            value = self.read(resource)
+            self.put_value(tag, '', value, PERCENT)
+            high = high or value >= self.threshold
+        self.interval = self.fast if high else self.base_interval
+
+    def close(self):
+        if self.epoll is not None:
+            asyncio.get_running_loop().remove_reader(self.epoll.fileno())
+            self.epoll.close()
+        for fd in self.triggers:
+            os.close(fd)
+#- Pressure
+
+
+class Sensors(Sampler):
+    # Temperatures, fan speeds and battery state from sysfs. The sensors are
+    # discovered once, then again on a slow timer for hotplugged batteries
+    # and late hwmon drivers. Their value files are kept open in between:
+    # a sample is one pread per file, without any path walk or open however
+    # many inputs there are.
+    interval = 5
+    # Seconds between two discoveries
+    rediscover = 300
+    # Time constant of the battery rate smoothing, in seconds
+    smoothing = 60
+    battery_files = (
+            'status', 'capacity',
+            'energy_now', 'energy_full', 'power_now',
+            'charge_now', 'charge_full', 'current_now',
+            )
+
+    def __init__(self, queue: StatusStore, rediscover=None):
+        super().__init__(queue)
+        if rediscover is not None:
+            self.rediscover = rediscover
+        # Tag suffix -> open value file
+        self.temps = {}
+        self.fans = {}
+        # Power supply name -> {file name: open file}
+        self.batteries = {}
+        self.discovered = None
+        # Battery status, smoothed rate, and when it was last updated
+        self.status = None
+        self.rate = None
+        self.rate_time = None
+        # Last energy level seen and since when, when no rate is reported
+        self.energy = None
+        self.energy_time = None
+
+    @staticmethod
+    def entries(path: str, prefix: str = ''):
+        try:
+            return sorted(entry for entry in os.listdir(os.path.join(SYS_ROOT, path))
+                    if entry.startswith(prefix))
+        except OSError:
+            return []
+
+    @staticmethod
+    def label(path: str):
+        try:
+            with open(os.path.join(SYS_ROOT, path)) as f:
+                return f.readline().strip()
+        except OSError:
+            return None
+
+    @staticmethod
+    def add(sensors: dict, name: str, path: str):
+        # Tags can't have spaces, and several zones may have the same type
+        name = name.replace(' ', '_')
+        unique, number = name, 1
+        while unique in sensors:
+            number += 1
+            unique = f'{name}{number}'
+        try:
+            sensors[unique] = ProcFile(path, size=64, root=SYS_ROOT)
+        except OSError:
+            pass
+
+    def discover(self):
+        self.close()
+        for zone in self.entries('class/thermal', 'thermal_zone'):
+            path = f'class/thermal/{zone}'
+            self.add(self.temps, self.label(f'{path}/type') or zone, f'{path}/temp')
+        for device in self.entries('class/hwmon', 'hwmon'):
+            path = f'class/hwmon/{device}'
+            chip = self.label(f'{path}/name') or device
+            for entry in self.entries(path):
+                # temp1_input, fan1_input...
+                sensor, _, kind = entry.partition('_')
+                if kind != 'input':
+                    continue
+                if sensor.startswith('temp'):
+                    sensors = self.temps
+                elif sensor.startswith('fan'):
+                    sensors = self.fans
+                else:
+                    continue
+                label = self.label(f'{path}/{sensor}_label') or sensor
+                self.add(sensors, f'{chip}-{label}', f'{path}/{entry}')
+        for supply in self.entries('class/power_supply'):
+            path = f'class/power_supply/{supply}'
+            if self.label(f'{path}/type') != 'Battery':
+                continue
+            files = {}
+            for name in self.battery_files:
+                with suppress(OSError):
+                    files[name] = ProcFile(f'{path}/{name}', size=64, root=SYS_ROOT)
+            if files:
+                self.batteries[supply] = files
+        self.discovered = time.monotonic()
+
+    @staticmethod
+    def read(sysfile: ProcFile) -> bytes:
+        buffer = sysfile.read()
+        return bytes(buffer[:sysfile.length]).strip()
+
+    def read_all(self, sensors: dict, scale: int):
+        values = {}
+        for name, sysfile in sensors.items():
+            try:
+                values[name] = int(self.read(sysfile)) / scale
+            except (OSError, ValueError):
+                # Sensor asleep or failing, no value this time
+                continue
+        return values
+
+    def sample_batteries(self, now: float):
+        statuses = []
+        capacities = []
+        energy = full = rate = 0
+        for files in self.batteries.values():
+            values = {}
+            for name, sysfile in files.items():
+                with suppress(OSError):
+                    values[name] = self.read(sysfile)
+            statuses.append(values.get('status', b'Unknown').decode())
+            if 'capacity' in values:
+                capacities.append(int(values['capacity']) / 100)
+            # Energy in µWh and power in µW, or charge in µAh and current in
+            # µA: either way, their ratio is in hours
+            if 'energy_now' in values:
+                now_key, full_key, rate_key = 'energy_now', 'energy_full', 'power_now'
+            else:
+                now_key, full_key, rate_key = 'charge_now', 'charge_full', 'current_now'
+            energy += int(values.get(now_key, 0))
+            full += int(values.get(full_key, 0))
+            # Negative while discharging on some firmwares
+            rate += abs(int(values.get(rate_key, 0)))
+        if 'Discharging' in statuses:
+            status = 'Discharging'
+        elif 'Charging' in statuses:
+            status = 'Charging'
+        else:
+            status = statuses[0]
+        if status != self.status:
+            # Plugged or unplugged, the previous rate means nothing now
+            self.status = status
+            self.rate = self.energy = None
+        if not rate and self.energy is not None and energy != self.energy:
+            # No rate reported, estimate it from the last energy change
+            rate = abs(energy - self.energy) / ((now - self.energy_time) / 3600)
+        if energy != self.energy:
+            self.energy, self.energy_time = energy, now
+        if rate:
+            if self.rate is None:
+                self.rate = rate
+            else:
+                # Exponential moving average over time, whatever the interval
+                alpha = 1 - math.exp(-(now - self.rate_time) / self.smoothing)
+                self.rate += alpha * (rate - self.rate)
+            self.rate_time = now
+        hours = None
+        if self.rate and status == 'Discharging':
+            hours = energy / self.rate
+        elif self.rate and status == 'Charging':
+            hours = max(full - energy, 0) / self.rate
+        if full:
+            capacity = energy / full
+        elif capacities:
+            capacity = sum(capacities) / len(capacities)
+        else:
+            capacity = 0
+        self.put_value('battery', '', min(capacity, 1), PERCENT)
+        self.put('batterystatus', '', status)
+        self.put('batterytime', '', f'{int(hours)}:{int(hours * 60) % 60:02d}' if hours is not None else '')
+
+    def sample(self):
+        now = time.monotonic()
+        if self.discovered is None or now - self.discovered >= self.rediscover:
+            self.discover()
+        for kind, sensors, scale, format in [
+                ('temp', self.temps, 1000, TEMP),
+                ('fan', self.fans, 1, FAN),
+                ]:
+            values = self.read_all(sensors, scale)
+            for name, value in values.items():
+                self.put_value(f'{kind}@{name}', '', value, format)
+            if values:
+                # The hottest sensor, the fastest fan
+                self.put_value(kind, '', max(values.values()), format)
+        if self.batteries:
+            self.sample_batteries(now)
+
+    def close(self):
+        for sysfile in [*self.temps.values(), *self.fans.values()]:
+            sysfile.close()
+        for files in self.batteries.values():
+            for sysfile in files.values():
+                sysfile.close()
+        self.temps = {}
+        self.fans = {}
+        self.batteries = {}
+#- Sensors
+
+
+class Demand(Sampler):
+    # Tell whether anybody reads the statuses of a sampler: subscribers of
+    # the socket server say which tags they want, while readers of the
+    # status files are found by looking for inotify watches on the status
+    # directory among the processes of the user. Readers of the shared table
+    # can't be told, so everything is wanted with the mmap backend. The tags
+    # given are always wanted, e.g. the blocks printed by --output. Without
+    # root nor unknown readers (--backend none), only those and the socket
+    # subscribers count.
+    interval = 30
+    adaptive = False
+
+    def __init__(self, queue: StatusStore, root=None, server=None, tags=None, unknown=False):
+        super().__init__(queue)
+        self.root = root
+        self.server = server
+        self.tags = frozenset(tags or [])
+        # Readers that can't be told, or found watching root
+        self.everything = unknown
+        self.uid = os.getuid()
+        self.on_wanted = None
+
+    @staticmethod
+    def encode_dev(dev: int) -> int:
+        # Device number as shown in inotify fdinfo: the kernel-internal
+        # s_dev, 12 bits of major above 20 bits of minor
+        return (os.major(dev) << 20) | os.minor(dev)
+
+    def watches(self):
+        # Yield (device, inode) of every inotify watch of the user
+        for entry in os.scandir('/proc'):
+            if not entry.name.isdigit():
+                continue
+            try:
+                if entry.stat().st_uid != self.uid:
+                    continue
+                for fd in os.scandir(f'{entry.path}/fd'):
+                    if os.readlink(fd.path) != 'anon_inode:inotify':
+                        continue
+                    with open(f'{entry.path}/fdinfo/{fd.name}') as f:
+                        for line in f:
+                            if not line.startswith('inotify'):
+                                continue
+                            fields = dict(
+                                    field.split(':', 1)
+                                    for field in line.split()[1:]
+                                    if ':' in field
+                                    )
+                            yield int(fields['sdev'], 16), int(fields['ino'], 16)
+            except (OSError, KeyError, ValueError):
+                # Process gone, or not ours to look at
+                continue
+
+    def sample(self):
+        if self.root is None:
+            return
+        try:
+            st = os.stat(self.root)
+        except FileNotFoundError:
+            self.everything = False
+            return
+        root = (self.encode_dev(st.st_dev), st.st_ino)
+        everything = any(watch == root for watch in self.watches())
+        if everything and not self.everything and self.on_wanted is not None:
+            self.on_wanted()
+        self.everything = everything
+
+    def wanted(self, sampler: Sampler) -> bool:
+        if self.everything or not sampler.statuses:
+            return True
+        if not self.tags.isdisjoint(sampler.statuses):
+            return True
+        clients = self.server.clients.values() if self.server is not None else []
+        return any(
+                tags is None or not tags.isdisjoint(sampler.statuses)
+                for tags in clients
+                )
+#- Demand
+
+
+class TickScheduler:
+    # Run all the samplers from one task, on ticks anchored to the wall
+    # clock (multiples of their interval since the epoch), so that samplers
+    # due at about the same time wake the process up only once. A sampler
+    # is also run on the current tick if it is due within its slack.
+    #
+    # Samplers only put their statuses in the queue, and the scheduler
+    # doesn't yield while running them: the consumer then gets everything
+    # sampled on a tick as one batch.
+    #
+    # In adaptive mode, the interval of a sampler is doubled, up to the
+    # ceiling, each time its statuses did not change for the given number of
+    # samples, and back to its base interval as soon as they change. Samplers
+    # whose statuses nobody reads are suspended.
+    def __init__(self, adaptive=False, samples=5, ceiling=60, demand=None, stats=None):
+        self.due = {}
+        self.adaptive = adaptive
+        self.samples = samples
+        self.ceiling = ceiling
+        self.demand = demand
+        self.stats = stats
+        self.waiter = None
+
+    def register(self, sampler: Sampler):
+        # First sample as soon as started
+        self.due[sampler] = 0
+
+    def unregister(self, sampler: Sampler):
+        self.due.pop(sampler, None)
+
+    @staticmethod
+    def next_tick(now: float, interval: float) -> float:
+        # Allow some rounding error when now is itself a tick
+        return (math.floor(now / interval + 1e-6) + 1) * interval
+
+    def adapt(self, sampler: Sampler):
+        if sampler.changed:
+            sampler.stable = 0
+            sampler.interval = sampler.base_interval
+            return
+        sampler.stable += 1
+        if sampler.stable >= self.samples:
+            sampler.stable = 0
+            sampler.interval = min(
+                    2 * sampler.interval,
+                    max(self.ceiling, sampler.base_interval),
+                    )
+
+    def tick(self, now: float):
+        for sampler, due in list(self.due.items()):
+            if due > now + sampler.slack:
+                continue
+            if self.adaptive and sampler.adaptive and self.demand is not None:
+                sampler.suspended = not self.demand.wanted(sampler)
+                if sampler.suspended:
+                    # Check again later, or as soon as resumed
+                    self.due[sampler] = self.next_tick(max(now, due), self.ceiling)
+                    continue
+            sampler.changed = False
+            start = time.perf_counter()
+            try:
+                sampler.sample()
+            except Exception as e:
+                print(f'{sampler.name}: {e!r}, disabled', file=sys.stderr, flush=True)
+                self.unregister(sampler)
+                continue
+            if self.stats is not None:
+                self.stats.observe(self.stats.samples, sampler.name, time.perf_counter() - start)
+            if self.adaptive and sampler.adaptive:
+                self.adapt(sampler)
+            self.due[sampler] = self.next_tick(max(now, due), sampler.interval)
+
+    def trigger(self, sampler: Sampler):
+        # Sample now, out of schedule
+        if sampler in self.due:
+            self.due[sampler] = 0
+            self.wakeup()
+
+    def wakeup(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def resume(self):
+        # Some statuses may be wanted again: sample suspended samplers now,
+        # at their base rate
+        for sampler in self.due:
+            if sampler.suspended:
+                sampler.suspended = False
+                sampler.interval = sampler.base_interval
+                self.due[sampler] = 0
+        self.wakeup()
+
+    def reanchor(self, now: float):
+        # The wall clock went back: due times are as far in the future,
+        # bring them back to the next tick of each sampler
+        for sampler, due in self.due.items():
+            self.due[sampler] = min(due, self.next_tick(now, sampler.interval))
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        # Wall clock minus monotonic clock, only changes when the wall clock
+        # is stepped
+        offset = time.time() - time.monotonic()
+        while self.due:
+            due = min(self.due.values())
+            # Wake up at least once per shortest interval of the samplers
+            # running, so that a step of the wall clock is noticed. Suspended
+            # samplers are only checked at the ceiling anyway.
+            delay = min(
+                    due - time.time(),
+                    min((sampler.interval for sampler in self.due if not sampler.suspended),
+                        default=self.ceiling),
+                    )
+            if delay > 0:
+                # Like asyncio.sleep(), but may be woken up early by resume()
+                self.waiter = loop.create_future()
+                handle = loop.call_later(delay, self.wakeup)
+                try:
+                    await self.waiter
+                finally:
+                    handle.cancel()
+            now = time.time()
+            skew = now - time.monotonic()
+            if skew < offset - 1:
+                self.reanchor(now)
+            offset = skew
+            if self.stats is not None and delay > 0 and now >= due:
+                # How late the event loop woke us up
+                self.stats.lag.observe(now - due)
+            self.tick(now)
+#- TickScheduler
+
+
+class Histogram:
+    # Cumulative counts of values up to each bound, Prometheus style
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(list(self.bounds) + ['+Inf'], self.buckets):
+            total += count
+            yield str(bound), total
+
+    def as_dict(self):
+        return {
+                'count': self.count,
+                'sum': self.sum,
+                'max': self.max,
+                'buckets': dict(self.cumulative()),
+                }
+#- Histogram
+
+
+class Stats:
+    # Durations in seconds, queue depths in items
+    durations = (1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1)
+    depths = (1, 2, 4, 8, 16, 32, 64, 128, 256, 1024)
+
+    def __init__(self):
+        # Per sampler and per D-Bus signal durations
+        self.samples = {}
+        self.callbacks = {}
+        self.lag = Histogram(self.durations)
+        self.depth = Histogram(self.depths)
+        self.writes = Counter()
+        self.skipped = Counter()
+        self.conflated = Counter()
+
+    def observe(self, family: dict, name: str, value: float):
+        histogram = family.get(name)
+        if histogram is None:
+            histogram = family[name] = Histogram(self.durations)
+        histogram.observe(value)
+
+    def timed(self, family: dict, name: str, callback):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return callback(*args, **kwargs)
+            finally:
+                self.observe(family, name, time.perf_counter() - start)
+        return wrapper
+
+    def as_dict(self):
+        return {
+                'samples': {name: h.as_dict() for name, h in self.samples.items()},
+                'callbacks': {name: h.as_dict() for name, h in self.callbacks.items()},
+                'loop_lag': self.lag.as_dict(),
+                'queue_depth': self.depth.as_dict(),
+                'writes': dict(self.writes),
+                'skipped': dict(self.skipped),
+                'conflated': dict(self.conflated),
+                }
+
+    def prometheus(self):
+        lines = []
+
+        def histogram(metric, h, labels=''):
+            for bound, count in h.cumulative():
+                lines.append(f'{metric}_bucket{{{labels}le="{bound}"}} {count}')
+            lines.append(f'{metric}_sum{{{labels.rstrip(",")}}} {h.sum}')
+            lines.append(f'{metric}_count{{{labels.rstrip(",")}}} {h.count}')
+
+        lines.append('# TYPE ui_statuses_sample_seconds histogram')
+        for name, h in self.samples.items():
+            histogram('ui_statuses_sample_seconds', h, f'sampler="{name}",')
+        lines.append('# TYPE ui_statuses_callback_seconds histogram')
+        for name, h in self.callbacks.items():
+            histogram('ui_statuses_callback_seconds', h, f'signal="{name}",')
+        lines.append('# TYPE ui_statuses_loop_lag_seconds histogram')
+        histogram('ui_statuses_loop_lag_seconds', self.lag)
+        lines.append('# TYPE ui_statuses_queue_depth histogram')
+        histogram('ui_statuses_queue_depth', self.depth)
+        for metric, counter in [
+                ('writes', self.writes),
+                ('skipped_writes', self.skipped),
+                ('conflated_statuses', self.conflated),
+                ]:
+            lines.append(f'# TYPE ui_statuses_{metric}_total counter')
+            for tag, count in counter.items():
+                lines.append(f'ui_statuses_{metric}_total{{tag="{tag}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path: str, format: str = 'json'):
+        text = self.prometheus() if format == 'prometheus' \
+                else json.dumps(self.as_dict(), indent=2) + '\n'
+        temp = f'{path}.tmp'
+        with open(temp, mode='w') as f:
+            f.write(text)
+        os.replace(temp, path)
+#- Stats
+
+
+class StatsSampler(Sampler):
+    # Publish a summary of the statistics as stats.* tags
+    name = 'stats'
+    interval = 10
+    adaptive = False
+
+    def __init__(self, queue: StatusStore, stats: Stats):
+        super().__init__(queue)
+        self.stats = stats
+
+    def sample(self):
+        stats = self.stats
+        for name, h in stats.samples.items():
+            self.put(f'stats.{name}', '', f'{h.mean * 1e6:.0f} µs')
+        for name, h in stats.callbacks.items():
+            self.put(f'stats.{name}', '', f'{h.mean * 1e6:.0f} µs')
+        self.put('stats.lag', '', f'{stats.lag.mean * 1e3:.1f} ms')
+        self.put('stats.queue', '', f'{stats.depth.max}')
+        self.put('stats.writes', '', f'{sum(stats.writes.values())}')
+        self.put('stats.skipped', '', f'{sum(stats.skipped.values())}')
+        self.put('stats.conflated', '', f'{sum(stats.conflated.values())}')
+#- StatsSampler
+
+
+class FileBackend:
+    def __init__(self, root: str):
+        self.root = root
+        if not os.path.isdir(root):
+            os.mkdir(root, mode=0o700)
+
+    def write(self, tag: str, line: str):
+        # Write to a temporary file then rename it over the status file, so
+        # that readers never see a truncated or half-written status
+        dest = os.path.join(self.root, tag)
+        temp = os.path.join(self.root, f'.{tag}.tmp')
+        with open(temp, mode='w') as f:
+            f.write(line)
+        os.replace(temp, dest)
         #  print(text, flush=True)
+#- FileBackend
+
+
+class StatusServer:
+    # Clients send one line with the comma-separated tags they subscribe to
+    # (an empty line for all tags), then receive batches of "tag<TAB>status"
+    # lines, each batch ending with an empty line. The first batch is a
+    # snapshot of the current statuses.
+    max_buffer_size = 64 * 1024
+
+    def __init__(self, path: str):
+        self.path = path
+        self.statuses = {}
+        self.clients = {}
+        self.pending = {}
+        self.server = None
+        self.on_subscribe = None
+
+    async def start(self):
+        with suppress(FileNotFoundError):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(
+                self.handle_client, path=self.path)
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        with suppress(FileNotFoundError):
+            os.unlink(self.path)
+
+    @staticmethod
+    def encode(statuses):
+        lines = [f'{tag}\t{line}\n' for tag, line in statuses.items()]
+        return ''.join(lines).encode() + b'\n'
+
+    def send(self, writer, statuses, tags):
+        if tags is not None:
+            statuses = {tag: statuses[tag] for tag in statuses if tag in tags}
+            if not statuses:
+                return
+        if writer.transport.get_write_buffer_size() > self.max_buffer_size:
+            # The client doesn't read anymore
+            writer.close()
+            return
+        writer.write(self.encode(statuses))
+
+    async def handle_client(self, reader, writer):
+        try:
+            line = await reader.readline()
+            tags = {tag for tag in line.decode().strip().split(',') if tag}
+            tags = tags or None
+            self.clients[writer] = tags
+            if self.on_subscribe is not None:
+                self.on_subscribe()
+            self.send(writer, self.statuses, tags)
+            # Nothing else is expected from the client but end of file
+            while await reader.read(1024):
+                pass
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.pop(writer, None)
+            writer.close()
+
+    def write(self, tag: str, line: str):
+        line = line.replace('\n', ' ')
+        self.statuses[tag] = line
+        # Send all the statuses written in the same loop iteration as one
+        # batch
+        if not self.pending:
+            asyncio.get_running_loop().call_soon(self.flush)
+        self.pending[tag] = line
+
+    def flush(self):
+        pending, self.pending = self.pending, {}
+        for writer, tags in list(self.clients.items()):
+            self.send(writer, pending, tags)
+#- StatusServer
+
+
+class BarOutput:
+    # Stream the statuses straight to a bar on stdout, one block per tag:
+    # polybar lines, waybar custom module JSON (return-type json), or the
+    # i3bar protocol (also swaybar). Each block is rendered again only when
+    # its status changed, and the whole line written at most once per frame.
+    def __init__(self, kind: str, blocks, bottom=True, frame=0.05, stream=None):
+        # Shared with the readers, installed next to this script
+        from uistatuses import PolybarFormat, PangoFormat
+        self.kind = kind
+        self.frame = frame
+        self.stream = stream or sys.stdout.buffer
+        self.positions = {tag: position for position, (tag, _, _) in enumerate(blocks)}
+        if kind == 'polybar':
+            self.renderers = [
+                    PolybarFormat(bgcolor, hicolor, bottom).render
+                    for _, bgcolor, hicolor in blocks
+                    ]
+        elif kind == 'waybar':
+            self.renderers = [
+                    PangoFormat(bgcolor, hicolor, bottom).render_json
+                    for _, bgcolor, hicolor in blocks
+                    ]
+        else:
+            self.renderers = [
+                    self.i3bar_block(PangoFormat(bgcolor, hicolor, bottom), tag)
+                    for tag, bgcolor, hicolor in blocks
+                    ]
+            self.stream.write(b'{"version": 1}\n[\n')
+        self.segments = [b''] * len(blocks)
+        self.flushed = -math.inf
+        self.pending = None
+        # Called once the bar closed its end of the stream
+        self.on_close = None
+        self.closed = False
+
+    @staticmethod
+    def i3bar_block(pango, tag):
+        # Background and line are drawn by the markup
+        head = json.dumps({
+                'name': tag,
+                'markup': 'pango',
+                'separator': False,
+                'separator_block_width': 0,
+                })[:-1].encode()
+        def render(line):
+            return head + b', "full_text": ' + json.dumps(pango.render(line)).encode() + b'}'
+        return render
+
+    def write(self, tag: str, line: str):
+        position = self.positions.get(tag)
+        if position is None or self.closed:
+            return
+        self.segments[position] = self.renderers[position](line)
+        if self.pending is None:
+            loop = asyncio.get_running_loop()
+            delay = max(self.flushed + self.frame - loop.time(), 0)
+            self.pending = loop.call_later(delay, self.flush)
+
+    def flush(self):
+        self.pending = None
+        self.flushed = asyncio.get_running_loop().time()
+        if self.kind == 'polybar':
+            output = b' '.join(self.segments) + b'\n'
+        elif self.kind == 'waybar':
+            output = b'{"text": "' + b' '.join(self.segments) + b'"}\n'
+        else:
+            output = b'[' + b', '.join(segment for segment in self.segments if segment) + b'],\n'
+        try:
+            self.stream.write(output)
+            self.stream.flush()
+        except BrokenPipeError:
+            # The bar is gone
+            self.closed = True
+            if self.stream is sys.stdout.buffer:
+                # What is left in the buffer can't be flushed at exit either
+                os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            if self.on_close is not None:
+                self.on_close()
+#- BarOutput
+
+
+def get_backend(args):
+    if args.backend == 'none':
+        return None
+    if args.backend == 'mmap':
+        # Shared with the readers, installed next to this script
+        from uistatuses import StatusTableWriter
+        return StatusTableWriter(args.table)
+    return FileBackend(args.root)
+
+async def consumer(backends: list, queue: StatusStore, stats=None):
+    # Last line written per tag, so that unchanged values don't touch the
+    # backend (and don't wake up every reader)
+    written = {}
+
+    def format_status(icon: str, output: str):
+        return f'{icon} {output}' if icon else f'{output}'
 
     while True:
-        tag, icon, output = await queue.get()
-        write_status(tag, icon, output)
+        # Everything put since the previous batch, the latest value of each
+        # tag only
+        batch = await queue.get()
+        if stats is not None:
+            stats.depth.observe(len(batch))
+        for tag, (icon, output) in batch.items():
+            line = format_status(icon, output)
+            if written.get(tag) != line:
+                for backend in backends:
+                    backend.write(tag, line)
+                written[tag] = line
+                if stats is not None:
+                    stats.writes[tag] += 1
+            elif stats is not None:
+                stats.skipped[tag] += 1
         queue.task_done()
 
 async def main(args):
-    # Create a queue that we will use to store our "workload".
-    queue = asyncio.Queue()
-    # Set up glib mailoop
+    # Latest statuses not written yet
+    stats = Stats()
+    queue = StatusStore(stats)
     loop = asyncio.get_running_loop()
-    glib_loop = GLib.MainLoop()
-    fut = loop.run_in_executor(None, glib_loop.run)
     # Create worker tasks to process the queue concurrently.
     tasks = []
-    if args.cpu:
-        tasks.append(asyncio.create_task(cpupercent(queue)))
+    backends = [backend for backend in [get_backend(args)] if backend is not None]
+    if args.output:
+        output = BarOutput(
+                args.output,
+                args.block,
+                bottom=not args.output_top,
+                frame=args.output_frame / 1000,
+                )
+        # Spawned by the bar, there is nobody to sample for anymore
+        output.on_close = lambda: [task.cancel() for task in tasks]
+        backends.append(output)
+    server = None
+    if args.socket:
+        server = StatusServer(args.socket)
+        await server.start()
+        backends.append(server)
+    loop.add_signal_handler(
+            signal.SIGUSR1, stats.dump, args.stats_file, args.stats_format)
+    scheduler = TickScheduler(
+            adaptive=args.adaptive,
+            samples=args.adaptive_samples,
+            ceiling=args.adaptive_ceiling,
+            stats=stats,
+            )
+    if args.stats:
+        scheduler.register(StatsSampler(queue, stats))
+    if args.adaptive:
+        root = args.root if args.backend == 'files' else None
+        # The blocks of the bar output are read all the time
+        tags = [tag for tag, _, _ in args.block] if args.output else None
+        scheduler.demand = Demand(
+                queue, root=root, server=server, tags=tags, unknown=args.backend == 'mmap')
+        scheduler.register(scheduler.demand)
+        scheduler.demand.on_wanted = scheduler.resume
+        if server is not None:
+            server.on_subscribe = scheduler.resume
+    if args.cpu or args.cpu_detail:
+        scheduler.register(CpuPercent(queue, detail=args.cpu_detail))
     if args.load:
-        tasks.append(asyncio.create_task(loadavg(queue)))
+        scheduler.register(LoadAvg(queue))
     if args.mem:
-        tasks.append(asyncio.create_task(mempercent(queue)))
+        scheduler.register(MemPercent(queue))
     if args.net:
-        tasks.append(asyncio.create_task(netspeed(queue)))
+        scheduler.register(NetSpeed(queue, args.net_include, args.net_exclude))
+    if args.disk:
+        scheduler.register(DiskIO(queue, args.disk_include, args.disk_exclude, args.disk_stacked))
+    if args.topproc:
+        scheduler.register(TopProc(queue, args.topproc_count, args.topproc_interval))
+    if args.pressure:
+        try:
+            pressure = Pressure(queue, args.pressure_threshold / 100)
+        except FileNotFoundError as e:
+            print(f'pressure: {e}, not available', file=sys.stderr, flush=True)
+        else:
+            pressure.on_stall = scheduler.trigger
+            scheduler.register(pressure)
+    if args.sensors:
+        scheduler.register(Sensors(queue, args.sensors_rediscover))
+    if scheduler.due:
+        tasks.append(asyncio.create_task(scheduler.run()))
     if args.vol:
-        tasks.append(asyncio.create_task(volume(queue)))
+        notifier = None
+        if args.volume_notify == 'notification':
+            notifier = VolumeNotification()
+        elif args.volume_notify == 'xob':
+            notifier = VolumeXob()
+        tasks.append(asyncio.create_task(
+                volume(queue, frame=args.volume_frame / 1000, notifier=notifier)))
     if args.mpris:
-        tasks.append(asyncio.create_task(mpris(queue)))
-    tasks.append(asyncio.create_task(consumer(args.root, queue)))
+        tasks.append(asyncio.create_task(mpris(queue, stats=stats, frame=args.mpris_frame / 1000)))
+    tasks.append(asyncio.create_task(consumer(backends, queue, stats=stats)))
     try:
         await asyncio.gather(*tasks, return_exceptions=True)
     except KeyboardInterrupt:
@@ -526,8 +2236,8 @@ async def main(args):
     except asyncio.CancelledError as e:
         pass
     finally:
-        GLib.idle_add(glib_loop.quit)
-        await fut
+        if server is not None:
+            server.close()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -535,10 +2245,109 @@ if __name__ == '__main__':
     parser.add_argument('-a', '--all', action='store_true', help='all statuses')
 
     parser.add_argument('-c', '--cpu', action='store_true', help='cpu percent usage')
+    parser.add_argument(
+            '-C', '--cpu-detail',
+            action='store_true',
+            help='cpu percent usage per core and per state (not included in --all)',
+            )
     parser.add_argument('-l', '--load', action='store_true', help='load average')
     parser.add_argument('-m', '--mem', action='store_true', help='memory percent and swap usage')
     parser.add_argument('-n', '--net', action='store_true', help='network download/upload speed/total')
-    parser.add_argument('-v', '--vol', action='store_true', help='volume status')
+    parser.add_argument(
+            '--net-include',
+            help='only sum network interfaces matching PATTERN. Can be given multiple times',
+            action='append',
+            metavar='PATTERN',
+            )
+    parser.add_argument(
+            '--net-exclude',
+            help=f'ignore network interfaces matching PATTERN (default: {" ".join(NetSpeed.virtual)}). '
+                'Can be given multiple times',
+            action='append',
+            metavar='PATTERN',
+            )
+    parser.add_argument(
+            '-d', '--disk',
+            action='store_true',
+            help='disk read/write throughput, IOPS and utilization (not included in --all)',
+            )
+    parser.add_argument(
+            '--disk-include',
+            help='only sum block devices matching PATTERN. Can be given multiple times',
+            action='append',
+            metavar='PATTERN',
+            )
+    parser.add_argument(
+            '--disk-exclude',
+            help='ignore block devices matching PATTERN (default: loop* ram* zram*), '
+                'partitions are always ignored. Can be given multiple times',
+            action='append',
+            metavar='PATTERN',
+            )
+    parser.add_argument(
+            '--disk-stacked',
+            action='store_true',
+            help='also sum device-mapper and md devices, whose i/o is already counted on their disks',
+            )
+    parser.add_argument(
+            '-t', '--topproc',
+            action='store_true',
+            help='processes using the most cpu and memory (not included in --all)',
+            )
+    parser.add_argument(
+            '--topproc-count',
+            type=int,
+            default=3,
+            metavar='N',
+            help='processes published as topcpu1..N and topmem1..N (default: 3)',
+            )
+    parser.add_argument(
+            '--topproc-interval',
+            type=float,
+            default=5,
+            metavar='SECONDS',
+            help='interval between two scans of the processes (default: 5)',
+            )
+    parser.add_argument(
+            '-P', '--pressure',
+            action='store_true',
+            help='cpu, memory and io pressure stall (not included in --all)',
+            )
+    parser.add_argument(
+            '--pressure-threshold',
+            type=float,
+            default=10,
+            metavar='PERCENT',
+            help='stall time that wakes the pressure sampler up (or, before linux 6.5, polled every 10 '
+                'seconds), and keeps it sampling every 2 seconds (default: 10)',
+            )
+    parser.add_argument(
+            '-s', '--sensors',
+            action='store_true',
+            help='temperatures, fan speeds and battery (not included in --all)',
+            )
+    parser.add_argument(
+            '--sensors-rediscover',
+            type=float,
+            default=300,
+            metavar='SECONDS',
+            help='interval between two discoveries of the thermal zones, hwmon inputs and batteries '
+                '(default: 300)',
+            )
+    parser.add_argument('-v', '--vol', action='store_true', help='volume and microphone status')
+    parser.add_argument(
+            '--volume-frame',
+            type=float,
+            default=50,
+            metavar='MS',
+            help='coalesce the volume changes received within MS milliseconds (default: 50)',
+            )
+    parser.add_argument(
+            '--volume-notify',
+            choices=['notification', 'xob'],
+            help='show the volume changes of the default sink, as desktop notifications or on an xob bar, '
+                'at most once per volume frame',
+            )
     parser.add_argument('-p', '--mpris', action='store_true', help='mpris player status')
     parser.add_argument(
             '-b', '--blacklist',
@@ -547,15 +2356,135 @@ if __name__ == '__main__':
             metavar="BUS_NAME",
             default=[],
             )
+    parser.add_argument(
+            '--mpris-frame',
+            type=float,
+            default=50,
+            metavar='MS',
+            help='coalesce the player signals received within MS milliseconds (default: 50)',
+            )
+    parser.add_argument(
+            '--adaptive',
+            action='store_true',
+            help='sample less often while statuses are stable, and not at all while nobody reads them',
+            )
+    parser.add_argument(
+            '--adaptive-samples',
+            type=int,
+            default=5,
+            metavar='N',
+            help='unchanged samples before doubling the interval (default: 5)',
+            )
+    parser.add_argument(
+            '--adaptive-ceiling',
+            type=float,
+            default=60,
+            metavar='SECONDS',
+            help='longest interval between two samples (default: 60)',
+            )
+    parser.add_argument(
+            '--history',
+            type=int,
+            default=0,
+            metavar='N',
+            help='keep the last N samples of numeric statuses, and publish their sparkline, '
+                'minimum, maximum, mean and EWMA as TAG.spark, TAG.min, TAG.max, TAG.mean and TAG.ewma',
+            )
+    parser.add_argument(
+            '--history-tag',
+            action='append',
+            metavar='PATTERN',
+            help='keep the history of the statuses matching PATTERN (default: the totals, '
+                'e.g. cpupercent but not cpu0). Can be given multiple times',
+            )
+    parser.add_argument(
+            '--sparkline-width',
+            type=int,
+            default=10,
+            metavar='N',
+            help='samples drawn in sparklines (default: 10)',
+            )
+    parser.add_argument(
+            '--proc',
+            default='/proc',
+            metavar='PATH',
+            help='read system statistics from PATH instead of /proc (e.g. recorded fixtures)',
+            )
+    parser.add_argument(
+            '--sys',
+            default='/sys',
+            metavar='PATH',
+            help='discover sensors in PATH instead of /sys',
+            )
     parser.add_argument('--truncate-text', default='…')
     parser.add_argument('--icon-playing', default='')
     parser.add_argument('--icon-paused', default='')
     parser.add_argument('--icon-stopped', default='')
     parser.add_argument('--icon-none', default='')
 
-    root = os.environ['XDG_RUNTIME_DIR']
-    root = os.path.join(root, 'ui-statuses')
+    runtime_dir = os.environ['XDG_RUNTIME_DIR']
+    root = os.path.join(runtime_dir, 'ui-statuses')
     parser.add_argument('--root', default=root)
+    parser.add_argument(
+            '--backend',
+            choices=['files', 'mmap', 'none'],
+            default='files',
+            help='write one file per status in ROOT, or a shared memory-mapped table, '
+                'or nothing (e.g. with --output)',
+            )
+    table = os.path.join(runtime_dir, 'ui-statuses.table')
+    parser.add_argument('--table', default=table, help='shared table for the mmap backend')
+    socket = os.path.join(runtime_dir, 'ui-statuses.sock')
+    parser.add_argument(
+            '--socket',
+            nargs='?',
+            const=socket,
+            metavar='PATH',
+            help=f'also publish statuses to subscribers of a unix socket (default: {socket})',
+            )
+    parser.add_argument(
+            '--output',
+            choices=['i3bar', 'waybar', 'polybar'],
+            help='also stream the statuses of the blocks to stdout, for a bar',
+            )
+
+    def block(value):
+        tag, _, colors = value.partition(':')
+        bgcolor, _, hicolor = colors.partition(':')
+        return tag, bgcolor or '#00000000', hicolor or '#ffffff'
+    parser.add_argument(
+            '--block',
+            action='append',
+            type=block,
+            metavar='TAG[:BGCOLOR[:HICOLOR]]',
+            help='status shown by --output, with its colors as #AARRGGBB. Can be given multiple times '
+                '(default: cpupercent, mempercent, downspeed and upspeed)',
+            )
+    parser.add_argument(
+            '--output-top',
+            action='store_true',
+            help='bar at the top of the screen: underline the blocks instead of overlining them',
+            )
+    parser.add_argument(
+            '--output-frame',
+            type=float,
+            default=50,
+            metavar='MS',
+            help='write the blocks to stdout at most once every MS milliseconds (default: 50)',
+            )
+    parser.add_argument(
+            '--stats',
+            action='store_true',
+            help='publish statistics about ui-statuses itself as stats.* statuses',
+            )
+    stats_file = os.path.join(runtime_dir, 'ui-statuses.stats')
+    parser.add_argument(
+            '--stats-file',
+            default=stats_file,
+            metavar='PATH',
+            help=f'where to dump statistics on SIGUSR1 (default: {stats_file})',
+            )
+    parser.add_argument('--stats-format', choices=['json', 'prometheus'], default='json')
 
     args = parser.parse_args()
 
@@ -567,9 +2496,32 @@ if __name__ == '__main__':
         args.vol = True
         args.mpris = True
 
-    if not os.path.isdir(args.root):
-        os.mkdir(args.root, mode=0o700)
-
+    PROC_ROOT = args.proc
+    SYS_ROOT = args.sys
+    if args.block is None:
+        # Same colors as polybar-sysmon
+        args.block = [
+                ('cpupercent', '#7fcc0000', '#c0392b'),
+                ('mempercent', '#5fff79c6', '#f012be'),
+                ('downspeed', '#5fffb86c', '#ff851b'),
+                ('upspeed', '#5fc4a000', '#fce947'),
+                ]
+    if args.history > 0:
+        HISTORY = History(
+                args.history,
+                min(args.sparkline_width, args.history),
+                args.history_tag or [
+                    'cpupercent',
+                    'mempercent',
+                    'swapused',
+                    'loadavg',
+                    'downspeed',
+                    'upspeed',
+                    'diskread',
+                    'diskwrite',
+                    'diskutil',
+                    ],
+                )
     BLACKLIST = args.blacklist
     TRUNCATE_STRING = args.truncate_text
     ICON_PLAYING = args.icon_playing
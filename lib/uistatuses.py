@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+
+# Helpers shared by ui-statuses and the status readers.
+#
+# Formats of the statuses for the bars, as polybar markup or pango markup
+# (waybar, i3bar and swaybar): the icon in the highlight color, on the
+# background color, over- or underlined with the highlight color.
+#
+# Shared status table, an alternative to the per-tag status files.
+#
+# All the statuses live in one fixed-layout file, memory-mapped by the
+# daemon and by every reader:
+#
+#   header  magic, version, slot count, slot size, generation counter
+#   slots   sequence counter, value length, tag, value
+#
+# The daemon allocates one slot per tag and updates it seqlock style: the
+# sequence counter is odd while the slot is being written. The global
+# generation counter is bumped after every update, so that readers can tell
+# cheaply whether anything changed. Reading is plain memory access, without
+# any system call.
+#
+# When all the slots are used, the daemon doubles their count: slots are
+# only ever appended, and readers map the file again when they see more
+# slots than they mapped.
+
+import os
+import sys
+import mmap
+import json
+import struct
+import asyncio
+from html import escape
+from contextlib import suppress
+
+MAGIC = b'UIST'
+VERSION = 2
+NSLOTS = 256
+SLOT_SIZE = 512
+
+# magic, version, slot count, slot size, generation
+HEADER = struct.Struct('=4sHxxIIQ')
+HEADER_SIZE = 64
+GENERATION_OFFSET = 16
+# sequence, value length, tag
+SLOT_HEADER = struct.Struct('=QH6x64s')
+TAG_OFFSET = 16
+TAG_SIZE = 64
+VALUE_OFFSET = SLOT_HEADER.size
+VALUE_SIZE = SLOT_SIZE - VALUE_OFFSET
+
+COUNTER = struct.Struct('=Q')
+LENGTH = struct.Struct('=H')
+LENGTH_OFFSET = 8
+# Reads of a slot or of the whole table retried while being written, before
+# giving up: the daemon may have died in the middle of a write
+RETRIES = 1000
+
+
+def runtime_dir():
+    return os.environ.get('XDG_RUNTIME_DIR', f'/run/user/{os.getuid()}')
+
+
+def default_path():
+    return os.path.join(runtime_dir(), 'ui-statuses.table')
+
+
+def default_socket():
+    return os.path.join(runtime_dir(), 'ui-statuses.sock')
+
+
+def table_size(nslots=NSLOTS):
+    return HEADER_SIZE + nslots * SLOT_SIZE
+
+
+def slot_offset(index):
+    return HEADER_SIZE + index * SLOT_SIZE
+
+
+class StatusTableWriter:
+    def __init__(self, path, nslots=NSLOTS):
+        self.path = path
+        self.nslots = nslots
+        self.slots = {}
+        # Tags too long for a slot, reported once
+        self.rejected = set()
+        self.map = None
+        magic = version = count = slot_size = None
+        with suppress(OSError, ValueError, struct.error):
+            with open(path, 'rb') as f:
+                magic, version, count, slot_size, _ = HEADER.unpack(f.read(HEADER.size))
+        if (magic, version, slot_size) == (MAGIC, VERSION, SLOT_SIZE) and count >= nslots:
+            # Keep the slots of a previous run, so that readers with cached
+            # slot indexes don't need to look them up again
+            self.map_file(count)
+            self.recover()
+            self.slots = {
+                    tag: index
+                    for index, tag in enumerate(iter_tags(self.map, count))
+                    if tag
+                    }
+        else:
+            self.map_file(nslots, clear=True)
+            HEADER.pack_into(self.map, 0, MAGIC, VERSION, nslots, SLOT_SIZE, 0)
+
+    def map_file(self, nslots, clear=False):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            size = table_size(nslots)
+            if clear:
+                os.ftruncate(fd, 0)
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.nslots = nslots
+
+    def recover(self):
+        # A slot left odd by a crash in the middle of a write would stay
+        # odd after every later write, and readers wait for an even one
+        for index in range(self.nslots):
+            offset = slot_offset(index)
+            seq = COUNTER.unpack_from(self.map, offset)[0]
+            if seq & 1:
+                length = LENGTH.unpack_from(self.map, offset + LENGTH_OFFSET)[0]
+                LENGTH.pack_into(self.map, offset + LENGTH_OFFSET, min(length, VALUE_SIZE))
+                COUNTER.pack_into(self.map, offset, seq + 1)
+
+    def grow(self):
+        # New slots are appended, the existing ones don't move
+        nslots = 2 * self.nslots
+        self.map_file(nslots)
+        HEADER.pack_into(
+                self.map, 0, MAGIC, VERSION, nslots, SLOT_SIZE,
+                COUNTER.unpack_from(self.map, GENERATION_OFFSET)[0] + 1)
+        print(f'{self.path}: all the slots are used, now {nslots}', file=sys.stderr, flush=True)
+
+    def allocate(self, tag):
+        index = len(self.slots)
+        if index >= self.nslots:
+            self.grow()
+        self.slots[tag] = index
+        return index
+
+    def write(self, tag: str, line: str) -> bool:
+        index = self.slots.get(tag)
+        if index is None:
+            encoded = tag.encode()
+            if len(encoded) > TAG_SIZE:
+                # Truncated, it could be mistaken for another tag
+                if tag not in self.rejected:
+                    self.rejected.add(tag)
+                    print(f'{self.path}: tag longer than {TAG_SIZE} bytes, not written: {tag}',
+                            file=sys.stderr, flush=True)
+                return False
+            index = self.allocate(tag)
+        value = line.encode()[:VALUE_SIZE]
+        offset = slot_offset(index)
+        seq = COUNTER.unpack_from(self.map, offset)[0]
+        # Odd sequence: slot is being written
+        COUNTER.pack_into(self.map, offset, seq + 1)
+        SLOT_HEADER.pack_into(
+                self.map, offset, seq + 1, len(value), tag.encode())
+        start = offset + VALUE_OFFSET
+        self.map[start:start + len(value)] = value
+        COUNTER.pack_into(self.map, offset, seq + 2)
+        generation = COUNTER.unpack_from(self.map, GENERATION_OFFSET)[0]
+        COUNTER.pack_into(self.map, GENERATION_OFFSET, generation + 1)
+        return True
+
+    def close(self):
+        self.map.close()
+#- StatusTableWriter
+
+
+def iter_tags(buffer, nslots):
+    for index in range(nslots):
+        start = slot_offset(index) + TAG_OFFSET
+        yield bytes(buffer[start:start + TAG_SIZE]).rstrip(b'\0').decode()
+
+
+class StatusTableReader:
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        self.map = None
+        self.map_file()
+        self.slots = {}
+        self.scanned = None
+
+    def map_file(self):
+        with open(self.path, 'rb') as f:
+            map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, nslots, slot_size, _ = HEADER.unpack_from(map)
+        if (magic, version, slot_size) != (MAGIC, VERSION, SLOT_SIZE) \
+                or len(map) < table_size(nslots):
+            map.close()
+            raise ValueError(f'{self.path}: not a status table')
+        if self.map is not None:
+            self.map.close()
+        self.map = map
+        self.nslots = nslots
+
+    @property
+    def generation(self):
+        return COUNTER.unpack_from(self.map, GENERATION_OFFSET)[0]
+
+    def scan(self):
+        # Only look for new slots when the table changed since the last scan
+        generation = self.generation
+        if generation != self.scanned:
+            self.scanned = generation
+            if HEADER.unpack_from(self.map)[2] != self.nslots:
+                # Grown by the daemon
+                self.map_file()
+            self.slots = {
+                    tag: index
+                    for index, tag in enumerate(iter_tags(self.map, self.nslots))
+                    if tag
+                    }
+
+    def slot(self, tag: str):
+        index = self.slots.get(tag)
+        if index is None:
+            self.scan()
+            index = self.slots.get(tag)
+        return index
+
+    def read(self, tag: str):
+        index = self.slot(tag)
+        if index is None:
+            return None
+        offset = slot_offset(index)
+        start = offset + VALUE_OFFSET
+        for _ in range(RETRIES):
+            seq, length, _ = SLOT_HEADER.unpack_from(self.map, offset)
+            if seq & 1:
+                continue
+            value = self.map[start:start + min(length, VALUE_SIZE)]
+            if COUNTER.unpack_from(self.map, offset)[0] == seq:
+                return value.decode(errors='ignore')
+        # Left half written
+        return None
+
+    def snapshot(self, tags=None):
+        # Retry until no update happened while reading, so that all the
+        # values belong to the same generation, or give the latest values
+        for _ in range(RETRIES):
+            generation = self.generation
+            if tags is None:
+                self.scan()
+                names = list(self.slots)
+            else:
+                names = tags
+            values = {tag: self.read(tag) for tag in names}
+            if self.generation == generation:
+                break
+        return values
+
+    def close(self):
+        self.map.close()
+#- StatusTableReader
+
+
+def rgba(color: str) -> str:
+    # Polybar colors are #AARRGGBB, pango and i3bar ones #RRGGBBAA
+    if len(color) == 9:
+        return f'#{color[3:]}{color[1:3]}'
+    return color
+
+
+class PolybarFormat:
+    # Everything around the icon and the text only depends on the colors,
+    # rendered once
+    def __init__(self, bgcolor: str, hicolor: str, bottom=True):
+        tag = 'o' if bottom else 'u'
+        self.prefix = f'%{{{tag}{hicolor}}}%{{+{tag}}}%{{B{bgcolor}}} '.encode()
+        self.suffix = f' %{{B-}}%{{-{tag}}}'.encode()
+        self.icon_prefix = f'%{{F{hicolor}}}'.encode()
+        self.icon_suffix = b'%{F-}'
+
+    def render(self, line: str) -> bytes:
+        if not line:
+            return self.prefix + self.suffix
+        return b''.join([
+                self.prefix,
+                self.icon_prefix, line[0].encode(), self.icon_suffix,
+                line[1:].encode(),
+                self.suffix,
+                ])
+#- PolybarFormat
+
+
+class PangoFormat:
+    def __init__(self, bgcolor: str, hicolor: str, bottom=True):
+        # Like polybar: the line is on the inner side of the bar
+        line = 'overline' if bottom else 'underline'
+        bgcolor, hicolor = rgba(bgcolor), rgba(hicolor)
+        self.prefix = f'<span background="{bgcolor}" {line}="single" {line}_color="{hicolor}"> '
+        self.suffix = ' </span>'
+        self.icon_prefix = f'<span foreground="{hicolor}">'
+        self.icon_suffix = '</span>'
+
+    def render(self, line: str) -> str:
+        if not line:
+            return self.prefix + self.suffix
+        return ''.join([
+                self.prefix,
+                self.icon_prefix, escape(line[0]), self.icon_suffix,
+                escape(line[1:]),
+                self.suffix,
+                ])
+
+    def render_json(self, line: str) -> bytes:
+        # As the content of a JSON string
+        return json.dumps(self.render(line))[1:-1].encode()
+#- PangoFormat
+
+
+# Subscribe to the statuses published by ui-statuses --socket, and yield
+# them batch by batch as {tag: status} dicts. The first batch is a snapshot
+# of the current statuses.
+async def subscribe(path=None, tags=None):
+    reader, writer = await asyncio.open_unix_connection(path or default_socket())
+    try:
+        writer.write((','.join(tags or []) + '\n').encode())
+        await writer.drain()
+        batch = {}
+        async for line in reader:
+            line = line.decode().rstrip('\n')
+            if line:
+                tag, _, status = line.partition('\t')
+                batch[tag] = status
+            else:
+                yield batch
+                batch = {}
+    finally:
+        writer.close()
+
+
+# vim: set ft=python fdm=indent ai ts=4 sw=4 tw=79 et:
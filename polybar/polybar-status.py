@@ -3,40 +3,78 @@
 import os
 import sys
 #  import locale
-import asyncio
-import inotify
-#  import argparse
+import argparse
+
+# asyncio and inotify are imported when needed only, the modules of a bar
+# may just run the small --connect client.
+#
+# With polybar-status --serve running, a module doesn't even need python:
+# its command only has to send "COLOR RESOURCE" and copy what comes back,
+# e.g. with the OpenBSD netcat:
+#
+#   exec = printf '%s %s\n' '#f1fa8c' volume | nc -U $XDG_RUNTIME_DIR/polybar-status.sock
+#
+# The client may close its side once the request is sent.
 
 #  encoding = locale.getpreferredencoding(False)
 
-def colorize(color, pathname):
+def colorize_line(color, line):
     icon = ''
     text = ''
-    with open(pathname) as f:
-        line = f.readline().rstrip()
-        if len(line):
-            icon = f'%{{F{color}}}{line[0]}%{{F-}}'
-            if len(line) > 1:
-                text = line[1:]
+    if len(line):
+        icon = f'%{{F{color}}}{line[0]}%{{F-}}'
+        if len(line) > 1:
+            text = line[1:]
     return f'{icon}{text}'
 
 
+def colorize(color, pathname):
+    with open(pathname) as f:
+        return colorize_line(color, f.readline().rstrip())
+
+
+def subscribe(socket, paths=[], color=None):
+    # Statuses are pushed by the daemon, no file is read at all
+    import asyncio
+    from uistatuses import subscribe
+    loop = asyncio.get_event_loop()
+    async def mainline() :
+        async for batch in subscribe(socket, paths):
+            for line in batch.values():
+                output = colorize_line(color, line)
+                if output:
+                    sys.stdout.write(f'{output}\n')
+                    sys.stdout.flush()
+        #end for
+    #end mainline
+    loop.run_until_complete(mainline())
+
+
 def main(root: str, paths=[], color=None):
+    import asyncio
+    import inotify
     loop = asyncio.get_event_loop()
-    paths_to_watch = list(
-            map(
-                lambda p: os.path.join(root, p),
-                paths if paths else os.listdir(root),
-                )
-            )
+    names_to_watch = set(paths if paths else os.listdir(root))
     async def mainline() :
         watcher = inotify.Watcher.create()
-        for path in paths_to_watch :
-            #  watcher.watch(path, inotify.IN.ALL_EVENTS)
-            watcher.watch(path, inotify.IN.MODIFY)
-        #end for
+        # Statuses are renamed over, so watch the directory instead of the
+        # files themselves
+        watcher.watch(root, inotify.IN.MOVED_TO)
+        # Statuses are only written when they change, start from the
+        # current ones
+        for name in sorted(names_to_watch):
+            try:
+                output = colorize(color, os.path.join(root, name))
+            except FileNotFoundError:
+                # Not written yet
+                continue
+            if output:
+                sys.stdout.write(f'{output}\n')
+                sys.stdout.flush()
         async for event in watcher.iter_async():
-            output = colorize(color, event.watch.pathname)
+            if event.pathname not in names_to_watch:
+                continue
+            output = colorize(color, os.path.join(root, event.pathname))
             if output:
                 sys.stdout.write(f'{output}\n')
                 sys.stdout.flush()
@@ -51,13 +89,188 @@ def main(root: str, paths=[], color=None):
     loop.run_until_complete(mainline())
 
 
+class Multiplexer:
+    # Serves all the modules of all the bars from one process: each client
+    # sends one line "COLOR RESOURCE", then receives the colorized statuses
+    # of RESOURCE, starting with the current one.
+    max_buffer_size = 64 * 1024
+
+    def __init__(self, root: str, path: str):
+        self.root = root
+        self.path = path
+        self.lines = {}
+        self.clients = {}
+        self.server = None
+
+    async def start(self):
+        import asyncio
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.server = await asyncio.start_unix_server(
+                self.handle_client, path=self.path)
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def send(self, writer, color, line):
+        if writer.transport.get_write_buffer_size() > self.max_buffer_size:
+            # The module doesn't read anymore
+            writer.close()
+            return
+        output = colorize_line(color, line)
+        if output:
+            writer.write(f'{output}\n'.encode())
+
+    def read(self, name):
+        try:
+            with open(os.path.join(self.root, name)) as f:
+                return f.readline().rstrip()
+        except FileNotFoundError:
+            return None
+
+    def publish(self, name, line):
+        if line is None or line == self.lines.get(name):
+            return
+        self.lines[name] = line
+        for color, writer in list(self.clients.get(name, ())):
+            self.send(writer, color, line)
+
+    async def handle_client(self, reader, writer):
+        subscriber = None
+        try:
+            request = (await reader.readline()).decode().strip()
+            color, _, resource = request.partition(' ')
+            name = os.path.basename(resource)
+            subscriber = (color, writer)
+            self.clients.setdefault(name, set()).add(subscriber)
+            line = self.lines.get(name)
+            if line is None:
+                line = self.lines[name] = self.read(name)
+            if line is not None:
+                self.send(writer, color, line)
+            # Nothing else is expected from the module but end of file.
+            # A client like nc may close its side after the request, the
+            # connection is only over when the statuses can't be sent
+            while await reader.read(1024):
+                pass
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+        finally:
+            if subscriber is not None:
+                self.clients[name].discard(subscriber)
+            writer.close()
+
+    async def watch(self):
+        import inotify
+        watcher = inotify.Watcher.create()
+        # Statuses are renamed over, so watch the directory instead of the
+        # files themselves
+        watcher.watch(self.root, inotify.IN.MOVED_TO)
+        async for event in watcher.iter_async():
+            if event.pathname in self.clients:
+                self.publish(event.pathname, self.read(event.pathname))
+        #end for
+
+    async def subscribe(self, socket):
+        # Statuses are pushed by the daemon, no file is read at all
+        from uistatuses import subscribe
+        async for batch in subscribe(socket):
+            for name, line in batch.items():
+                self.publish(name, line)
+        #end for
+#- Multiplexer
+
+
+def serve(root: str, path: str, socket=None):
+    import asyncio
+    loop = asyncio.get_event_loop()
+    multiplexer = Multiplexer(root, path)
+    async def mainline() :
+        await multiplexer.start()
+        try:
+            if socket is not None:
+                await multiplexer.subscribe(socket)
+            else:
+                await multiplexer.watch()
+        finally:
+            multiplexer.close()
+    #end mainline
+    loop.run_until_complete(mainline())
+
+
+def connect(path: str, color: str, resource: str) -> bool:
+    # Client of --serve, it only forwards the lines of one module
+    import socket as sockets
+    client = sockets.socket(sockets.AF_UNIX)
+    try:
+        client.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        client.close()
+        return False
+    client.sendall(f'{color} {resource}\n'.encode())
+    while True:
+        data = client.recv(4096)
+        if not data:
+            break
+        os.write(sys.stdout.fileno(), data)
+    return True
+
+
 if __name__ == '__main__':
-    root = os.environ['XDG_RUNTIME_DIR']
-    root = os.path.join(root, 'ui-statuses')
-    color = sys.argv[1]
-    resource = sys.argv[2]
+    runtime_dir = os.environ['XDG_RUNTIME_DIR']
+    root = os.path.join(runtime_dir, 'ui-statuses')
+
+    parser = argparse.ArgumentParser()
+    socket = os.path.join(runtime_dir, 'ui-statuses.sock')
+    parser.add_argument(
+            '--socket',
+            nargs='?',
+            const=socket,
+            metavar='PATH',
+            help=f'subscribe to ui-statuses --socket instead of watching files (default: {socket}), '
+                'give it after COLOR and RESOURCE',
+            )
+    multiplexer = os.path.join(runtime_dir, 'polybar-status.sock')
+    parser.add_argument(
+            '--serve',
+            nargs='?',
+            const=multiplexer,
+            metavar='PATH',
+            help=f'serve the statuses of all the modules on PATH (default: {multiplexer}), '
+                'without COLOR and RESOURCE. Modules may then run --connect, or any client sending '
+                '"COLOR RESOURCE" such as: printf \'%%s %%s\\n\' COLOR RESOURCE | nc -U PATH',
+            )
+    parser.add_argument(
+            '--connect',
+            nargs='?',
+            const=multiplexer,
+            metavar='PATH',
+            help=f'get the statuses from polybar-status --serve on PATH (default: {multiplexer}), '
+                'or watch them directly if it is not running. Give it after COLOR and RESOURCE',
+            )
+    parser.add_argument('color', nargs='?')
+    parser.add_argument('resource', nargs='?')
+    args = parser.parse_args()
+    if args.serve is None and args.resource is None:
+        parser.error('COLOR and RESOURCE are required')
+
     try:
-        asyncio.run(main(root, [resource], color=color))
+        if args.serve:
+            serve(root, args.serve, socket=args.socket)
+        elif args.connect and connect(args.connect, args.color, args.resource):
+            pass
+        elif args.socket:
+            subscribe(args.socket, [args.resource], color=args.color)
+        else:
+            main(root, [args.resource], color=args.color)
     except KeyboardInterrupt:
         print("\ninterrupt received, stopping…\n")
 
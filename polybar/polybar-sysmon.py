@@ -3,92 +3,169 @@
 import os
 import sys
 import asyncio
-import inotify
 import argparse
+# Shared with the daemon, installed next to this script
+from uistatuses import PolybarFormat
 
 
 class PolybarModule:
-    def __init__(self, resource, bgcolor, hicolor, bottom=True):
+    def __init__(self, resource, bgcolor, hicolor, bottom=True, table=None):
         self.resource = resource
+        self.name = os.path.basename(resource)
         self.bgcolor = bgcolor
         self.hicolor = hicolor
         self.tag = 'o' if bottom else 'u'
+        self.table = table
+        self.format = PolybarFormat(bgcolor, hicolor, bottom)
         self.buffer = ''
-        self.memoized = ''
-
-    def update(self):
-        with open(self.resource) as f:
-            line = f.readline().rstrip()
-            if line != self.buffer:
-                self.buffer = line
-                self.memoized = self.format_status(self.colorize_icon(line))
+        self.memoized = b''
+    #end __init__
+
+    def read(self):
+        if self.table is not None:
+            return self.table.read(self.name) or ''
+        try:
+            with open(self.resource) as f:
+                return f.readline().rstrip()
+        except FileNotFoundError:
+            # Not written yet
+            return ''
+    #end read
+
+    def update(self, line=None):
+        if line is None:
+            line = self.read()
+        if line == self.buffer:
+            return False
+        self.buffer = line
+        self.memoized = self.format.render(line)
+        return True
     #end update
 
     @property
     def status(self):
         return self.memoized
-
-    def colorize_icon(self, output):
-        icon = ''
-        text = ''
-        if len(output):
-            icon = f'%{{F{self.hicolor}}}{output[0]}%{{F-}}'
-            if len(output) > 1:
-                text = output[1:]
-        return f'{icon}{text}'
-    #end colorize_icon
-
-    def format_status(self, output):
-        #  return f'%{{{self.tag}{self.hicolor}}}%{{+{self.tag}}}%{{B{self.bgcolor}}} {output} %{{B-}}%{{-{self.tag}}}'
-        str_fmt = '%{{{0}{1}}}%{{+{0}}}%{{B{2}}} {3} %{{B-}}%{{-{0}}}'
-        return str_fmt.format(self.tag, self.hicolor, self.bgcolor, output)
-    #end format_status
 #end PolybarModule
 
 
-def main(modules, color=None):
+class PolybarOutput:
+    # One segment per module, only the changed ones are rendered again and
+    # all the changes pending are written at once
+    def __init__(self, modules, stream=None):
+        self.modules = modules
+        self.stream = stream or sys.stdout.buffer
+        self.positions = {name: position for position, name in enumerate(modules)}
+        self.segments = [module.status for module in modules.values()]
+        self.current = None
+        self.pending = False
+    #end __init__
+
+    def update(self, name, line=None):
+        module = self.modules[name]
+        if module.update(line):
+            self.segments[self.positions[name]] = module.status
+            self.schedule()
+    #end update
+
+    def update_all(self):
+        for name in self.modules:
+            self.update(name)
+    #end update_all
+
+    def schedule(self):
+        # Wait for the other events of the same read
+        if not self.pending:
+            self.pending = True
+            asyncio.get_running_loop().call_soon(self.flush)
+    #end schedule
+
+    def flush(self):
+        self.pending = False
+        output = b' '.join(self.segments) + b'\n'
+        if output != self.current:
+            self.current = output
+            self.stream.write(output)
+            self.stream.flush()
+    #end flush
+#end PolybarOutput
+
+
+def main(modules, table=None, interval=0.5, socket=None):
     loop = asyncio.get_event_loop()
-    paths_to_watch = [modules[key].resource for key in modules]
-    def get_fullstatus():
-        return ' '.join([modules[key].status for key in modules])
-    #end get_fullstatus
+    root = os.path.dirname(next(iter(modules.values())).resource)
+    output = PolybarOutput(modules)
+    async def pollline() :
+        # The shared table is updated in memory without any notification,
+        # so check its generation counter, which costs no system call
+        generation = None
+        while True:
+            if table.generation != generation:
+                generation = table.generation
+                output.update_all()
+            await asyncio.sleep(interval)
+        #end while
+    #end pollline
+    async def socketline() :
+        # Statuses are pushed by the daemon, no file is read at all
+        from uistatuses import subscribe
+        async for batch in subscribe(socket, list(modules)):
+            for name, line in batch.items():
+                output.update(name, line)
+        #end for
+    #end socketline
     async def mainline() :
-        current = get_fullstatus()
+        import inotify
         watcher = inotify.Watcher.create()
-        for path in paths_to_watch :
-            watcher.watch(path, inotify.IN.MODIFY)
-        #end for
+        # Statuses are renamed over, so watch the directory instead of the
+        # files themselves, and never read a file still being written
+        watcher.watch(root, inotify.IN.CLOSE_WRITE | inotify.IN.MOVED_TO)
+        # Statuses are only written when they change, start from the
+        # current ones
+        output.update_all()
         async for event in watcher.iter_async():
-            resource = event.watch.pathname
-            name = os.path.basename(resource)
-            modules[name].update()
-            output = get_fullstatus()
-            if output != current:
-                sys.stdout.write(f'{output}\n')
-                sys.stdout.flush()
-                current = output
+            name = event.pathname
+            if name not in modules:
+                continue
+            output.update(name)
         #end for
     #end mainline
-    loop.run_until_complete(mainline())
+    if socket is not None:
+        loop.run_until_complete(socketline())
+    elif table is not None:
+        loop.run_until_complete(pollline())
+    else:
+        loop.run_until_complete(mainline())
 #end main
 
 
-def get_module(name, root, args, bottom=True):
+def get_module(name, root, args, bottom=True, table=None):
     return PolybarModule(
             os.path.join(root, name),
             vars(args)[f'bg_{name}'],
             vars(args)[f'hi_{name}'],
             bottom=bottom,
+            table=table,
             )
 #end get_module
 
 
 if __name__ == '__main__':
-    root = os.environ['XDG_RUNTIME_DIR']
-    root = os.path.join(root, 'ui-statuses')
+    runtime_dir = os.environ['XDG_RUNTIME_DIR']
+    root = os.path.join(runtime_dir, 'ui-statuses')
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--top', action='store_true')
+    parser.add_argument('--backend', choices=['files', 'mmap'], default='files')
+    parser.add_argument('--table', default=os.path.join(runtime_dir, 'ui-statuses.table'))
+    parser.add_argument('--interval', type=float, default=0.5, help='polling interval of the mmap backend')
+    socket = os.path.join(runtime_dir, 'ui-statuses.sock')
+    parser.add_argument(
+            '--socket',
+            nargs='?',
+            const=socket,
+            metavar='PATH',
+            help=f'subscribe to ui-statuses --socket instead of watching files (default: {socket})',
+            )
     parser.add_argument('--bg-cpupercent', default='#7fcc0000')
     parser.add_argument('--hi-cpupercent', default='#c0392b')
     parser.add_argument('--bg-mempercent', default='#5fff79c6')
@@ -100,7 +177,11 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     bottom = False if args.top else True
-    modules = {name: get_module(name, root, args, bottom=bottom)
+    table = None
+    if args.backend == 'mmap':
+        from uistatuses import StatusTableReader
+        table = StatusTableReader(args.table)
+    modules = {name: get_module(name, root, args, bottom=bottom, table=table)
             for name in [
                 'cpupercent',
                 'mempercent',
@@ -109,7 +190,7 @@ if __name__ == '__main__':
                 ]
             }
     try:
-        asyncio.run(main(modules))
+        asyncio.run(main(modules, table=table, interval=args.interval, socket=args.socket))
     except KeyboardInterrupt:
         print("\n\ninterrupt received, stopping…\n")
 